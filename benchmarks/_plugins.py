@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load the plugins outside of Fledge for benchmarking
+Built for Masters Thesis project in 2024 by Markus Oja
+"""
+
+import importlib.util
+import logging
+import os
+import sys
+import types
+
+PLUGIN_ROOT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'fledge-docker', 'fledge')
+
+
+def _provide(name, **attributes):
+    """Stand in for a module only the Fledge services provide, if it is missing"""
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+
+
+def _setup_logger(name, level=logging.WARNING, **_):
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    return logger
+
+
+def load_plugin(kind, name):
+    """
+    Load a plugin module from fledge-docker/fledge/<kind>/<name>/<name>.py
+
+    filter_ingest and async_ingest are embedded by the Fledge C services,
+    and fledge.common.logger comes with a Fledge install. Stand-ins are used
+    for the ones that are missing, so the plugin code itself runs unchanged.
+    """
+    _provide('filter_ingest', filter_ingest_callback=lambda callback, ref, data: None)
+    _provide('async_ingest', ingest_callback=lambda callback, ref, data: None)
+    try:
+        importlib.import_module('fledge.common.logger')
+    except ImportError:
+        for module in ('fledge', 'fledge.common'):
+            sys.modules.setdefault(module, types.ModuleType(module))
+        logger = types.ModuleType('fledge.common.logger')
+        logger.setup = _setup_logger
+        sys.modules['fledge.common.logger'] = logger
+        sys.modules['fledge.common'].logger = logger
+
+    path = os.path.join(PLUGIN_ROOT, kind, name, f'{name}.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    # the plugins log every reading on debug level
+    logging.getLogger(spec.name).setLevel(logging.WARNING)
+    return module
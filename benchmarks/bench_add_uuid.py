@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the add-uuid generator against the original deepcopy and
+uuid.uuid4 per leaf implementation, and name based uuid5 leaves with
+and without hits in their cache.
+
+Usage: python3 benchmarks/bench_add_uuid.py [--readings N]
+"""
+
+import argparse
+import timeit
+import uuid
+from copy import deepcopy
+
+from _plugins import load_plugin
+
+CONFIG = {
+    "messageId": "uuid",
+    "correlationId": "uuid",
+    "data": {
+        "IdentifiedObject.mRID": "uuid",
+        "MeasurementValue.mRID": "uuid"
+    }
+}
+
+CONFIG_UUID7 = {
+    "messageId": "uuid7",
+    "correlationId": "uuid7",
+    "data": {
+        "IdentifiedObject.mRID": "uuid7",
+        "MeasurementValue.mRID": "uuid7"
+    }
+}
+
+
+# name based uuids of replayable readings
+CONFIG_UUID5 = {
+    "messageId": {"UUID5": {"FIELDS": ["asset", "timestamp"]}},
+    "correlationId": {"UUID5": {"FIELDS": ["asset", "timestamp", "value"]}},
+    "data": {
+        "IdentifiedObject.mRID": {"UUID5": {"FIELDS": ["asset"], "NAMESPACE": "oid"}},
+        "MeasurementValue.mRID": {"UUID5": {"FIELDS": ["asset", "value"]}}
+    }
+}
+
+
+def legacy_add_uuid(config, readings):
+    """ The original implementation, deepcopy and uuid4 per leaf """
+    def find_and_generate(dictionary):
+        for key, value in list(dictionary.items()):
+            if isinstance(value, dict):
+                find_and_generate(value)
+            else:
+                dictionary.update({key: str(uuid.uuid4())})
+        return dictionary
+
+    data = deepcopy(config)
+    readings.update(find_and_generate(data))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--readings', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    plugin = load_plugin('filter', 'add-uuid')
+    add = plugin.compile_uuids(CONFIG)
+    add7 = plugin.compile_uuids(CONFIG_UUID7)
+    add5 = plugin.compile_uuids(CONFIG_UUID5, args.readings)
+
+    def new_block(count):
+        return [{'asset': 'meter', 'timestamp': f'2024-01-01 00:00:{n:06d}',
+                 'readings': {'value': n, 'data': {'unit': 'W'}}}
+                for n in range(count)]
+
+    def uuids(readings):
+        return [readings['messageId'], readings['correlationId'],
+                readings['data']['IdentifiedObject.mRID'],
+                readings['data']['MeasurementValue.mRID']]
+
+    for version, run in ((4, add), (7, add7)):
+        checked = new_block(100)
+        run(checked)
+        values = [value for element in checked for value in uuids(element['readings'])]
+        assert all(uuid.UUID(value).version == version for value in values)
+        assert all(uuid.UUID(value).variant == uuid.RFC_4122 for value in values)
+        assert len(set(values)) == len(values)
+        # merged into the existing data dict
+        assert all(element['readings']['data']['unit'] == 'W' for element in checked)
+        if version == 7:
+            assert values == sorted(values)
+
+    checked, again = new_block(100), new_block(100)
+    add5(checked)
+    plugin.compile_uuids(CONFIG_UUID5)(again)
+    assert checked == again
+    assert checked[0]['readings']['messageId'] == str(
+        uuid.uuid5(uuid.NAMESPACE_URL, '\x1f'.join(('meter', checked[0]['timestamp']))))
+
+    block = new_block(args.readings)
+    # replayed readings hit the cache
+    add5(block)
+
+    print(f'{args.readings} readings with 4 uuids each, best of {args.repeat}')
+    report(args, {
+        'legacy uuid4': lambda: [legacy_add_uuid(CONFIG, e['readings']) for e in block],
+        'bulk uuid4': lambda: add(block),
+        'bulk uuid7': lambda: add7(block),
+        # a new generator has an empty cache, every name is new
+        'uuid5': lambda: plugin.compile_uuids(CONFIG_UUID5, args.readings)(block),
+        'uuid5 replayed': lambda: add5(block),
+    })
+
+
+def report(args, runs):
+    baseline = None
+    for name, run in runs.items():
+        best = min(timeit.repeat(run, number=1, repeat=args.repeat))
+        baseline = baseline or best
+        print(f'{name:>18}: {best * 1e6 / args.readings:8.2f} us/reading '
+              f'{baseline / best:6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the serializers of send-to-kafka: encode time and bytes per
+reading for AsyncAPI shaped readings, one reading per record and in
+envelopes of readings.
+
+msgpack and avro are skipped when msgpack or fastavro is not installed.
+
+Usage: python3 benchmarks/bench_kafka_serializers.py [--readings N]
+"""
+
+import argparse
+import tempfile
+import timeit
+import uuid
+
+from _plugins import load_plugin
+
+# Avro schema of READING
+AVRO_SCHEMA = {
+    "type": "record",
+    "name": "MeasurementMessage",
+    "namespace": "fledge.asyncapi",
+    "fields": [
+        {"name": "messageId", "type": "string"},
+        {"name": "headers", "type": {
+            "type": "record", "name": "Headers", "fields": [
+                {"name": "contentType", "type": "string"},
+                {"name": "schema", "type": "string"},
+                {"name": "source", "type": {"type": "map", "values": "string"}}
+            ]}},
+        {"name": "data", "type": {
+            "type": "record", "name": "MeasurementValue", "fields": [
+                {"name": "IdentifiedObject.mRID", "type": "string"},
+                {"name": "IdentifiedObject.name", "type": "string"},
+                {"name": "MeasurementValue.timeStamp", "type": "string"},
+                {"name": "MeasurementValue.value", "type": ["double", "string"]},
+                {"name": "MeasurementValue.sensorAccuracy", "type": "double"},
+                {"name": "MeasurementValueSource.source.name", "type": "string"},
+                {"name": "MeasurementValueQuality.validity", "type": "string"},
+                {"name": "Unit.symbol", "type": "string"},
+                {"name": "Unit.multiplier", "type": "string"}
+            ]}}
+    ]
+}
+
+
+def reading(n):
+    """ A reading as transform-to-asyncapi makes them """
+    return {
+        "messageId": str(uuid.uuid4()),
+        "headers": {
+            "contentType": "application/json",
+            "schema": "MeasurementValue",
+            "source": {"system": "Fledge", "site": "lab"}
+        },
+        "data": {
+            "IdentifiedObject.mRID": f"meter-{n % 50}",
+            "IdentifiedObject.name": "Measurement",
+            "MeasurementValue.timeStamp": f"2024-01-01T00:{n // 60 % 60:02d}:{n % 60:02d}Z",
+            "MeasurementValue.value": n * 0.37,
+            "MeasurementValue.sensorAccuracy": 0.5,
+            "MeasurementValueSource.source.name": "Fledge",
+            "MeasurementValueQuality.validity": "GOOD",
+            "Unit.symbol": "W",
+            "Unit.multiplier": "k"
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--readings', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--envelope', type=int, default=100,
+                        help='readings per envelope')
+    args = parser.parse_args()
+
+    plugin = load_plugin('north', 'send-to-kafka')
+    readings = [reading(n) for n in range(args.readings)]
+    registry = tempfile.mkdtemp(prefix='kafka-schemas-')
+
+    names = ['json', 'json-compact']
+    if plugin.msgpack is not None:
+        names.append('msgpack')
+    if plugin.fastavro is not None:
+        names.append('avro')
+
+    print(f'{args.readings} readings, best of {args.repeat}, '
+          f'envelopes of {args.envelope}')
+    print(f'{"":>14}  {"us/reading":>10}  {"bytes/reading":>13}  {"in envelopes":>12}')
+    for name in names:
+        serializer = plugin.make_serializer(name, AVRO_SCHEMA, registry)
+        enveloped = plugin.make_serializer(name, AVRO_SCHEMA, registry, envelope=True)
+        encode = serializer.encode
+
+        best = min(timeit.repeat(lambda: [encode(r) for r in readings],
+                                 number=1, repeat=args.repeat))
+        size = sum(len(encode(r)) for r in readings)
+        envelopes = sum(
+            len(enveloped.pack([enveloped.encode_item(r)
+                                for r in readings[start:start + args.envelope]]))
+            for start in range(0, len(readings), args.envelope))
+
+        print(f'{name:>14}  {best * 1e6 / args.readings:10.2f}  '
+              f'{size / args.readings:13.1f}  {envelopes / args.readings:12.1f}')
+
+
+if __name__ == '__main__':
+    main()
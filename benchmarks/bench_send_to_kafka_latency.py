@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark how responsive the north event loop stays while send-to-kafka
+sends to a slow broker, with the producer called inline and from the
+sender thread.
+
+The fake producer blocks in send() like KafkaProducer does with a full
+buffer or while fetching metadata, and acknowledges records after a delay.
+A ticker task measures how late the loop runs its 1 ms sleeps meanwhile.
+
+Usage: python3 benchmarks/bench_send_to_kafka_latency.py [--readings N]
+"""
+
+import argparse
+import asyncio
+import collections
+import queue
+import threading
+import time
+
+from _plugins import load_plugin
+
+RecordMetadata = collections.namedtuple('RecordMetadata', 'topic partition offset')
+
+
+class SlowProducer(object):
+    """ Stands in for KafkaProducer with a slow broker """
+
+    def __init__(self, future_class, stall_every, stall, ack_delay):
+        self.future_class = future_class
+        self.stall_every = stall_every
+        self.stall = stall
+        self.ack_delay = ack_delay
+        self.sent = 0
+        # one broker thread acknowledges the records in order
+        self.unacked = queue.Queue()
+        threading.Thread(target=self.acknowledge, daemon=True).start()
+
+    def send(self, topic, key, value):
+        self.sent += 1
+        if self.sent % self.stall_every == 0:
+            # buffer full or metadata fetch, send() blocks the caller
+            time.sleep(self.stall)
+        future = self.future_class()
+        self.unacked.put((time.perf_counter() + self.ack_delay, future,
+                          RecordMetadata(topic, 0, self.sent)))
+        return future
+
+    def acknowledge(self):
+        while True:
+            record = self.unacked.get()
+            if record is None:
+                return
+            due, future, metadata = record
+            time.sleep(max(0, due - time.perf_counter()))
+            future.success(metadata)
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self):
+        self.unacked.put(None)
+
+
+async def ticker(lags, stop):
+    """ Sleep 1 ms at a time and record how late each wake up is """
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - start - 0.001)
+
+
+async def run(plugin, mode, args, future_class):
+    plugin.KafkaProducer = lambda **config: SlowProducer(
+        future_class, args.stall_every, args.stall / 1000, args.ack_delay / 1000)
+    kafka = plugin.KafkaPlugin(max_in_flight=args.in_flight, send_mode=mode)
+    payload = [{'id': n, 'asset_code': 'meter', 'reading': {'value': n}}
+               for n in range(1, args.readings + 1)]
+
+    lags = []
+    stop = asyncio.Event()
+    ticking = asyncio.ensure_future(ticker(lags, stop))
+    start = time.perf_counter()
+    result = await plugin.plugin_send({'plugin': kafka}, payload, 1)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await ticking
+    kafka.close()
+
+    assert result == (True, args.readings, args.readings), result
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99)] if lags else 0
+    worst = lags[-1] if lags else 0
+    print(f'{mode:>8}: {args.readings / elapsed:9.0f} readings/s, loop lag '
+          f'p99 {p99 * 1000:7.2f} ms, max {worst * 1000:7.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--readings', type=int, default=5000)
+    parser.add_argument('--in-flight', type=int, default=1000)
+    parser.add_argument('--stall-every', type=int, default=500,
+                        help='send() blocks once every this many records')
+    parser.add_argument('--stall', type=float, default=50, help='ms send() blocks')
+    parser.add_argument('--ack-delay', type=float, default=5, help='ms to acknowledge')
+    args = parser.parse_args()
+
+    plugin = load_plugin('north', 'send-to-kafka')
+    from kafka.future import Future
+
+    print(f'{args.readings} readings, send() blocks {args.stall:g} ms '
+          f'every {args.stall_every} records')
+    loop = asyncio.new_event_loop()
+    try:
+        for mode in ('inline', 'thread'):
+            loop.run_until_complete(run(plugin, mode, args, Future))
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the transform-to-asyncapi renderer against the original
+deepcopy and walk implementation, shared constants against copied ones,
+the cost of schema validation, add-uuid and transform-to-asyncapi
+chained against one template with GENERATE, and block mode against
+rendering one reading at a time.
+
+Usage: python3 benchmarks/bench_transform_to_asyncapi.py [--readings N]
+"""
+
+import argparse
+import math
+import timeit
+from copy import deepcopy
+
+from _plugins import load_plugin
+
+TEMPLATE = {
+    "messageId": "measurement",
+    "headers": {
+        "contentType": "application/json",
+        "schema": "MeasurementValue",
+        "source": {"system": "Fledge", "site": "lab", "tags": ["rest", "kafka"]}
+    },
+    "data": {
+        "IdentifiedObject.mRID": {"CONFIG": {"LOCATION": "datasetId"}},
+        "IdentifiedObject.name": "Measurement",
+        "IdentifiedObject.description": "Value read from REST API",
+        "MeasurementValue.timeStamp": {"CONFIG": {"LOCATION": "time"}},
+        "MeasurementValue.value": {"CONFIG": {"LOCATION": "value"}},
+        "MeasurementValue.sensorAccuracy": 0.5,
+        "MeasurementValueSource.source.name": "Fledge",
+        "MeasurementValueQuality.validity": "GOOD",
+        "MeasurementValueQuality.source": "PROCESS",
+        "Unit.symbol": "W",
+        "Unit.multiplier": "k"
+    }
+}
+
+
+# numeric conversions that block mode vectorizes
+FORMAT_TEMPLATE = deepcopy(TEMPLATE)
+FORMAT_TEMPLATE["data"].update({
+    "MeasurementValue.value": {"CONFIG": {
+        "LOCATION": "value", "FORMAT": {"scale": 0.001, "round": 3}}},
+    "MeasurementValue.raw": {"CONFIG": {"LOCATION": "value", "FORMAT": "int"}},
+    "Temperature.celsius": {"CONFIG": {
+        "LOCATION": "kelvin", "FORMAT": {"offset": -273.15, "round": 1}}}
+})
+
+
+# the ids of add-uuid in the template itself, fused into one pass
+FUSED_TEMPLATE = deepcopy(TEMPLATE)
+FUSED_TEMPLATE["headers"]["messageId"] = {"GENERATE": "uuid7"}
+FUSED_TEMPLATE["data"]["MeasurementValue.mRID"] = {"GENERATE": "uuid4"}
+
+# the same with add-uuid before transform-to-asyncapi
+CHAIN_UUIDS = {"messageUuid": "uuid7", "valueUuid": "uuid4"}
+CHAIN_TEMPLATE = deepcopy(TEMPLATE)
+CHAIN_TEMPLATE["headers"]["messageId"] = {"CONFIG": {"LOCATION": "messageUuid"}}
+CHAIN_TEMPLATE["data"]["MeasurementValue.mRID"] = {"CONFIG": {"LOCATION": "valueUuid"}}
+
+# payload schema of TEMPLATE for the validation run
+SCHEMA = {
+    "type": "object",
+    "required": ["messageId", "headers", "data"],
+    "properties": {
+        "messageId": {"const": "measurement"},
+        "headers": {"type": "object", "required": ["contentType", "schema"]},
+        "data": {
+            "type": "object",
+            "required": ["IdentifiedObject.mRID", "MeasurementValue.value"],
+            "properties": {
+                "IdentifiedObject.mRID": {"type": "integer", "minimum": 0},
+                "MeasurementValue.timeStamp": {"type": "string", "minLength": 20},
+                "MeasurementValue.value": {"type": "number"},
+                "MeasurementValueQuality.validity": {"enum": ["GOOD", "INVALID"]}
+            }
+        }
+    }
+}
+
+
+def legacy_replace_pointers(config, readings):
+    """ The original implementation, deepcopy and walk per reading """
+    def replace_keywords(copy_of_config_json):
+        for key, value in list(copy_of_config_json.items()):
+            if isinstance(value, dict):
+                if value.get("CONFIG"):
+                    location = value['CONFIG'].get('LOCATION')
+                    new_value = readings.get(location)
+                    if new_value:
+                        copy_of_config_json[key] = new_value
+                    else:
+                        copy_of_config_json[key] = "NO VALUE"
+                else:
+                    replace_keywords(value)
+        return copy_of_config_json
+
+    data = deepcopy(config)
+    return replace_keywords(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--readings', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    plugin = load_plugin('filter', 'transform-to-asyncapi')
+    render = plugin.compile_template(TEMPLATE)
+    render_shared = plugin.compile_template(TEMPLATE, share=True)
+
+    block = [{'datasetId': n, 'time': '2024-01-01T00:00:00Z', 'value': n * 0.37,
+              'kelvin': 290 + n % 20}
+             for n in range(1, args.readings + 1)]
+
+    assert render(block[1]) == legacy_replace_pointers(TEMPLATE, block[1])
+    assert render_shared(block[1]) == render(block[1])
+    validate = plugin.compile_schema(SCHEMA)
+    assert validate(render(block[1])) == []
+
+    print(f'{args.readings} readings, best of {args.repeat}')
+    report(args, {
+        'legacy deepcopy': lambda: [legacy_replace_pointers(TEMPLATE, r) for r in block],
+        'compiled': lambda: [render(r) for r in block],
+        'shared constants': lambda: [render_shared(r) for r in block],
+        'shared + validated': lambda: [validate(render_shared(r)) for r in block],
+    })
+
+    add_uuids = load_plugin('filter', 'add-uuid').compile_uuids(CHAIN_UUIDS)
+    render_chain = plugin.compile_template(CHAIN_TEMPLATE, share=True)
+    render_fused = plugin.compile_template(FUSED_TEMPLATE, share=True)
+
+    def chained():
+        elements = [{'readings': dict(r)} for r in block]
+        add_uuids(elements)
+        return [render_chain(element['readings']) for element in elements]
+
+    chain, fused = chained()[1], render_fused(block[1])
+    assert chain.keys() == fused.keys() and len(fused['headers']['messageId']) == 36
+
+    print('with generated uuids')
+    report(args, {
+        'add-uuid, then': chained,
+        'fused GENERATE': lambda: [render_fused(r) for r in block],
+    })
+
+    if plugin.np is None:
+        print('numpy not installed, skipping block mode')
+        return
+
+    render = plugin.compile_template(FORMAT_TEMPLATE)
+    render_block = plugin.compile_block_template(FORMAT_TEMPLATE)
+    assert same(render_block(block[:100]), [render(r) for r in block[:100]])
+
+    print('with FORMAT conversions')
+    report(args, {
+        'one at a time': lambda: [render(r) for r in block],
+        'block mode': lambda: render_block(block),
+    })
+
+
+def same(left, right):
+    """ Equal, apart from how exact halves are rounded in the last decimal """
+    if isinstance(left, dict) and isinstance(right, dict):
+        return left.keys() == right.keys() and all(
+            same(left[key], right[key]) for key in left)
+    if isinstance(left, list) and isinstance(right, list):
+        return len(left) == len(right) and all(map(same, left, right))
+    if isinstance(left, float) or isinstance(right, float):
+        return math.isclose(left, right, abs_tol=1.001e-3)
+    return left == right
+
+
+def report(args, runs):
+    baseline = None
+    for name, run in runs.items():
+        best = min(timeit.repeat(run, number=1, repeat=args.repeat))
+        baseline = baseline or best
+        print(f'{name:>18}: {best * 1e6 / args.readings:8.2f} us/reading '
+              f'{baseline / best:6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,13 @@ For Fledge v2.4.0
 
 import logging
 from copy import deepcopy
+from functools import lru_cache
+import hashlib
 import json
+import os
+import re
+import threading
+import time
 import uuid
 
 from fledge.common import logger
@@ -29,6 +35,23 @@ UUID_CONFIG = {
     }
 }
 
+# version 4 (random) for "uuid", "uuid4" and any other leaf value
+DEFAULT_GENERATOR = "uuid4"
+
+# a leaf like {"UUID5": {"FIELDS": ["asset", "timestamp"], "NAMESPACE": "url"}}
+# gets a uuid5 from the values of the fields, the same for a replayed reading
+UUID5_KEY = "UUID5"
+
+_NAMESPACES = {
+    "dns": uuid.NAMESPACE_DNS,
+    "url": uuid.NAMESPACE_URL,
+    "oid": uuid.NAMESPACE_OID,
+    "x500": uuid.NAMESPACE_X500
+}
+
+# one step of a nested FIELDS location: ".key", "key" or "[0]"
+_PATH_STEP = re.compile(r'\.?(?:\[(\d+)\]|([^.\[\]]+))')
+
 
 _DEFAULT_CONFIG = {
     "plugin": {
@@ -50,6 +73,13 @@ _DEFAULT_CONFIG = {
         "default": "false",
         "displayName": "Enabled",
         "order": "2"
+    },
+    "uuid5CacheSize": {
+        "description": "Number of name based uuids remembered per UUID5 leaf",
+        "type": "integer",
+        "default": "4096",
+        "displayName": "UUID5 cache size",
+        "order": "3"
     }
 }
 
@@ -93,6 +123,8 @@ def plugin_init(config, ingest_ref, callback):
     handle = deepcopy(config)
     handle["callback"] = callback
     handle["ingestRef"] = ingest_ref
+    handle["generator"] = compile_uuids(handle['json']['value'],
+                                        int(handle['uuid5CacheSize']['value']))
     return handle
 
 
@@ -109,6 +141,8 @@ def plugin_reconfigure(handle, new_config):
     new_handle = deepcopy(new_config)
     new_handle["callback"] = handle["callback"]
     new_handle["ingestRef"] = handle["ingestRef"]
+    new_handle["generator"] = compile_uuids(new_handle['json']['value'],
+                                            int(new_handle['uuid5CacheSize']['value']))
     return new_handle
 
 
@@ -137,57 +171,277 @@ def plugin_ingest(handle, data):
         return
 
     # Filter is enabled: Get keys from json, get values for it from data
-    processed_data = []
-
     _LOGGER.debug(f'Readings before: {data}')
 
-    for element in data:
-        # modify only the readings-part
-        readings = element.get('readings')
+    # the uuids of the whole block are generated at once,
+    # modify only the readings-part
+    handle["generator"]([element for element in data if element.get('readings')])
 
-        if readings:
-            # go through the json and replace keywords generated values
-            add_uuid(handle['json']['value'], readings)
-            _LOGGER.debug(element)
-
-        processed_data.append(element)
-
- 
-    _LOGGER.debug(f'Readings after: {processed_data}')
+    _LOGGER.debug(f'Readings after: {data}')
 
     # Pass data onwards
     filter_ingest.filter_ingest_callback(
         handle["callback"],  
         handle["ingestRef"], 
-        processed_data
+        data
         )
 
     _LOGGER.debug(f'{PLUGIN_NAME} filter ingest done')
 
 
 def add_uuid(config, readings):
-    def find_and_generate(dictionary):
-        """
-        TODO: use vars instead of hard coded...
-        add formatting...
-        """
-        # using list to prevent errors
-        for key, value in list(dictionary.items()):
-
-            # everything with a value should be right row
-            if isinstance(value, dict):
-                # go deeper
-                find_and_generate(value)
-            else:
-                new_value = uuid.uuid4()
-                # without str shows UUID('new_value')
-                dictionary.update({key: str(new_value)})
-        return dictionary
-    
-    # use deepcopy and update instead of modifying directly the readings
-    data = deepcopy(config)
-    modified_data = find_and_generate(data)
+    """ Add new uuids to the readings at the leaves of config
 
+    Compiles the config on every call, plugin_ingest uses the generator
+    compiled once in plugin_init and plugin_reconfigure instead.
+    """
     # don't return, instead modify exising dictionary
-    readings.update(modified_data)
+    compile_uuids(config)([{'readings': readings}])
+
+
+def compile_uuids(config, cache_size=4096):
+    """ Compile the config json into a function adding the uuids to readings
+
+    The value of a leaf selects its uuid: "uuid7" for a time ordered
+    version 7 uuid, "uuid4" or anything else for a random version 4 uuid.
+    These are new for each reading, and the uuids of a whole block are
+    generated in bulk, see _GENERATORS. A UUID5 leaf gets a name based
+    uuid from fields of the reading, see _compile_uuid5.
+
+    The config is walked only here, into a flat plan of the dicts to write
+    to and the leaves to write in each. The uuids are merged deep into the
+    readings: existing dicts on the way to a leaf are kept with their other
+    keys, anything else on the way is replaced with a dict.
+
+    Args:
+        config:     the json with the keys to add
+        cache_size: uuids remembered per UUID5 leaf
+    Returns:
+        add: function taking a list of reading elements and adding the
+             uuids to their readings
+    """
+    kinds = []
+    plan = []
+    _compile_plan(config, (), plan, kinds, cache_size)
+    plan = tuple(plan)
+    counts = tuple((_GENERATORS[kind], kinds.count(kind)) for kind in _KINDS)
+
+    def add(elements):
+        count = len(elements)
+        if not count:
+            return
+        sources = tuple(iter(block(needed * count)).__next__ if needed else None
+                        for block, needed in counts)
+        for element in elements:
+            readings = element['readings']
+            for parents, leaves in plan:
+                target = readings
+                for parent in parents:
+                    child = target.get(parent)
+                    if type(child) is not dict:
+                        # a read-only or other dict is copied, not written to
+                        child = target[parent] = dict(child) if isinstance(child, dict) else {}
+                    target = child
+                for key, source, name_based in leaves:
+                    if name_based is None:
+                        target[key] = sources[source]()
+                    else:
+                        target[key] = name_based(element)
+    return add
+
+
+def _compile_plan(config, parents, plan, kinds, cache_size):
+    """ Add the leaves of a dict of the config to plan, in config order
+
+    An entry of plan is (path of a dict, leaves), leaves being the ones
+    next to each other in the config. A leaf is (key, index of its kind in
+    _KINDS, None), and its kind is appended to kinds. A UUID5 leaf is
+    (key, None, function of the element).
+    """
+    leaves = []
+    for key, value in config.items():
+        if isinstance(value, dict) and UUID5_KEY in value:
+            leaves.append((key, None, _compile_uuid5(value[UUID5_KEY], cache_size)))
+        elif isinstance(value, dict):
+            if leaves:
+                plan.append((parents, tuple(leaves)))
+                leaves = []
+            # go deeper
+            _compile_plan(value, parents + (key,), plan, kinds, cache_size)
+        else:
+            kind = _leaf_kind(value)
+            kinds.append(kind)
+            leaves.append((key, _KINDS.index(kind), None))
+
+    if leaves or not config:
+        plan.append((parents, tuple(leaves)))
+
+
+def _compile_uuid5(spec, cache_size):
+    """ Compile a UUID5 leaf into a function giving the uuid of an element
+
+    FIELDS are looked up from the element, like "asset" or "timestamp",
+    then at their location in its readings, a key or a nested one like
+    "a.b[0].c", as in the transform-to-asyncapi filter. A missing value is
+    empty. Their values joined are the name of the uuid5, in NAMESPACE: dns,
+    url (default), oid, x500 or a uuid. The same fields give the same uuid,
+    so a replayed reading keeps its identity. The uuids of the last
+    cache_size names are kept, least recently used go first.
+    """
+    fields = tuple(spec.get("FIELDS") or ("asset", "timestamp"))
+    getters = tuple((field, _compile_location(field)) for field in fields)
+    namespace = spec.get("NAMESPACE", "url")
+    namespace = _NAMESPACES.get(namespace) or uuid.UUID(namespace)
+
+    prefix = namespace.bytes
+
+    @lru_cache(maxsize=cache_size)
+    def uuid_of(name):
+        # same as str(uuid.uuid5(namespace, name)) without the UUID object
+        raw = bytearray(hashlib.sha1(prefix + name.encode()).digest()[:16])
+        raw[6] = (raw[6] & 0x0f) | 0x50
+        raw[8] = (raw[8] & 0x3f) | 0x80
+        hexed = raw.hex()
+        return f'{hexed[:8]}-{hexed[8:12]}-{hexed[12:16]}-{hexed[16:20]}-{hexed[20:]}'
+
+    def name_based(element):
+        readings = element.get('readings') or {}
+        values = []
+        for field, get in getters:
+            value = element.get(field)
+            if value is None:
+                value = get(readings)
+            values.append('' if value is None else str(value))
+        # unit separator, not likely to be in the values
+        return uuid_of('\x1f'.join(values))
+    return name_based
+
+
+def _compile_location(location):
+    """ Compile a FIELDS location into a function reading it from the readings
+
+    A key of the readings matching the whole location is used first.
+    """
+    steps = []
+    if isinstance(location, str):
+        pos = 0
+        while pos < len(location):
+            match = _PATH_STEP.match(location, pos)
+            if not match:
+                steps = []
+                break
+            index, key = match.groups()
+            steps.append(int(index) if index is not None else key)
+            pos = match.end()
+
+    if len(steps) <= 1:
+        return lambda readings: readings.get(location)
+
+    steps = tuple(steps)
+
+    def get(readings):
+        value = readings.get(location)
+        if value is not None:
+            return value
+        value = readings
+        try:
+            for step in steps:
+                value = value[step]
+        except (KeyError, IndexError, TypeError):
+            return None
+        return value
+
+    return get
+
+
+def _leaf_kind(value):
+    kind = value.strip().lower() if isinstance(value, str) else ''
+    return kind if kind in _GENERATORS else DEFAULT_GENERATOR
+
+
+# sets the version and variant bits of random bytes, see _uuid4_block
+_VERSION_4 = bytes((byte & 0x0f) | 0x40 for byte in range(256))
+_VARIANT = bytes((byte & 0x3f) | 0x80 for byte in range(256))
+
+
+def _uuid4_block(count):
+    """ count random version 4 uuids as strings
+
+    One read of os.urandom for all of them, the same source uuid.uuid4
+    reads 16 bytes at a time from. The version and variant bits are set
+    for all uuids with two translate calls on the bytes.
+    """
+    raw = bytearray(os.urandom(16 * count))
+    raw[6::16] = raw[6::16].translate(_VERSION_4)
+    raw[8::16] = raw[8::16].translate(_VARIANT)
+    hexed = raw.hex()
+    return [f'{hexed[i:i + 8]}-{hexed[i + 8:i + 12]}-{hexed[i + 12:i + 16]}-'
+            f'{hexed[i + 16:i + 20]}-{hexed[i + 20:i + 32]}'
+            for i in range(0, 32 * count, 32)]
+
+
+def _random_tails(count):
+    """ count random variant and rand_b ends of version 7 uuids """
+    raw = bytearray(os.urandom(8 * count))
+    raw[0::8] = raw[0::8].translate(_VARIANT)
+    hexed = raw.hex()
+    return [f'{hexed[i:i + 4]}-{hexed[i + 4:i + 16]}' for i in range(0, 16 * count, 16)]
+
+
+class _Uuid7Clock:
+    """ Millisecond timestamps and counters for version 7 uuids
+
+    The 12 bit rand_a field of a version 7 uuid is a counter within a
+    millisecond (RFC 9562, method 1), so uuids are ordered also within a
+    block. When the counter runs out, the next millisecond is used. Each
+    plugin module has its own clock, the uuids of one filter are never out
+    of order.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.millis = 0
+        self.counter = 0
+
+    def take(self, count):
+        """ Reserve count uuids, returns the (millisecond, counter) to start from """
+        with self.lock:
+            now = time.time_ns() // 1000000
+            if now > self.millis:
+                self.millis = now
+                self.counter = 0
+            start = (self.millis, self.counter)
+            self.counter += count
+            self.millis += self.counter >> 12
+            self.counter &= 0xfff
+            return start
+
+
+_UUID7_CLOCK = _Uuid7Clock()
+
+
+def _uuid7(millis, counter, tail):
+    """ The version 7 uuid of a millisecond, counter and random tail """
+    stamp = f'{millis:012x}'
+    return f'{stamp[:8]}-{stamp[8:]}-7{counter:03x}-{tail}'
+
+
+def _uuid7_block(count):
+    """ count time ordered version 7 uuids as strings """
+    millis, counter = _UUID7_CLOCK.take(count)
+    uuids = []
+    for tail in _random_tails(count):
+        uuids.append(_uuid7(millis, counter, tail))
+        counter += 1
+        if counter > 0xfff:
+            millis += 1
+            counter = 0
+    return uuids
+
+
+_GENERATORS = {
+    "uuid4": _uuid4_block,
+    "uuid7": _uuid7_block
+}
 
+_KINDS = tuple(_GENERATORS)
@@ -12,15 +12,54 @@ For Fledge v2.4.0
 
 import logging
 from copy import deepcopy
+from datetime import datetime, timezone
+from fnmatch import translate
+from functools import lru_cache
+import hashlib
 import json
+import os
+import re
+import threading
+import time
+import uuid
 
 from fledge.common import logger
 import filter_ingest
 
+# numpy is optional, only needed for block mode
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 _LOGGER = logger.setup(__name__, level=logging.DEBUG)
 
 PLUGIN_NAME = "transform-to-asyncapi"
 
+NO_VALUE = "NO VALUE"
+
+# {"GENERATE": "uuid4"} in the json is filled with a new uuid for each
+# reading, "uuid7" for time ordered ones. {"GENERATE": {"UUID5": {...}}}
+# gives a name based uuid from the asset, timestamp or readings values
+GENERATE_KEY = "GENERATE"
+UUID5_KEY = "UUID5"
+
+_NAMESPACES = {
+    "dns": uuid.NAMESPACE_DNS,
+    "url": uuid.NAMESPACE_URL,
+    "oid": uuid.NAMESPACE_OID,
+    "x500": uuid.NAMESPACE_X500
+}
+
+# one step of a LOCATION: a dotted key or a [n] list index
+_PATH_STEP = re.compile(r'\.?(?:\[(\d+)\]|([^.\[\]]+))')
+
+# key for the validation errors of tagged and dead letter readings
+ERRORS_KEY = "validationErrors"
+
+# routed asset codes remembered per handle, the cache is cleared when full
+_ROUTE_CACHE_SIZE = 4096
+
 
 JSON_DYNAMIC = {
     "data": {
@@ -53,6 +92,55 @@ _DEFAULT_CONFIG = {
         "default": "false",
         "displayName": "Enabled",
         "order": "2"
+    },
+    "blockMode": {
+        "description": "Convert numeric FORMAT values of the whole readings block "
+                       "at once with NumPy",
+        "type": "boolean",
+        "default": "false",
+        "displayName": "Block mode",
+        "order": "3"
+    },
+    "shareConstants": {
+        "description": "Share the constant parts of the json between readings "
+                       "instead of copying them, shared parts are read-only",
+        "type": "boolean",
+        "default": "false",
+        "displayName": "Share constants",
+        "order": "4"
+    },
+    "routes": {
+        "description": "Templates per asset code, keys are asset codes or glob "
+                       "patterns like \"meter_*\", others use the Config json",
+        "type": "JSON",
+        "default": json.dumps({}),
+        "displayName": "Routes",
+        "order": "5"
+    },
+    "schema": {
+        "description": "JSON Schema, or AsyncAPI document with the message payload "
+                       "schema, to validate transformed readings against",
+        "type": "JSON",
+        "default": json.dumps({}),
+        "displayName": "Schema",
+        "order": "6"
+    },
+    "invalidPolicy": {
+        "description": "What to do with readings not valid against the schema: "
+                       "drop them, tag them with the errors, or move them to the "
+                       "dead letter asset",
+        "type": "enumeration",
+        "default": "tag",
+        "options": ["drop", "tag", "deadletter"],
+        "displayName": "Invalid readings",
+        "order": "7"
+    },
+    "deadLetterAsset": {
+        "description": "Asset code for invalid readings with the deadletter policy",
+        "type": "string",
+        "default": "asyncapi_deadletter",
+        "displayName": "Dead letter asset",
+        "order": "8"
     }
 }
 
@@ -96,6 +184,7 @@ def plugin_init(config, ingest_ref, callback):
     handle = deepcopy(config)
     handle["callback"] = callback
     handle["ingestRef"] = ingest_ref
+    _compile_handle(handle)
     return handle
 
 
@@ -112,9 +201,31 @@ def plugin_reconfigure(handle, new_config):
     new_handle = deepcopy(new_config)
     new_handle["callback"] = handle["callback"]
     new_handle["ingestRef"] = handle["ingestRef"]
+    _compile_handle(new_handle)
     return new_handle
 
 
+def _compile_handle(handle):
+    """ Compile the json and routes of the handle into its renderers """
+    share = handle["shareConstants"]["value"] == "true"
+    block = handle["blockMode"]["value"] == "true"
+    if block and np is None:
+        _LOGGER.warning(f'{PLUGIN_NAME}: block mode needs numpy, '
+                        f'transforming readings one at a time')
+        block = False
+
+    def compile_renderers(template):
+        block_renderer = compile_block_template(template, share) if block else None
+        return compile_template(template, share), block_renderer
+
+    default = compile_renderers(handle['json']['value'])
+    handle["renderer"], handle["blockRenderer"] = default
+    handle["router"] = compile_routes(handle['routes']['value'], default, compile_renderers)
+    handle["validator"] = compile_policy(compile_schema(handle['schema']['value']),
+                                         handle['invalidPolicy']['value'],
+                                         handle['deadLetterAsset']['value'])
+
+
 def plugin_shutdown(handle):
     """ Shutdowns the plugin doing required cleanup.
 
@@ -141,19 +252,41 @@ def plugin_ingest(handle, data):
 
     # Filter is enabled: Get keys from json, get values for it from data
     processed_data = []
+    route = handle["router"]
+    validate = handle["validator"]
 
     _LOGGER.debug(f'Readings before: {data}')
 
+    if handle["blockRenderer"] is not None:
+        # transform the block at once per template, numeric formats are vectorized
+        groups = {}
+        for element in data:
+            if element.get('readings'):
+                renderers = route(element.get('asset'))
+                groups.setdefault(renderers, []).append(element)
+        for (_, render_block), elements in groups.items():
+            block = render_block([element['readings'] for element in elements], elements)
+            for element, new_data in zip(elements, block):
+                element['readings'] = new_data
+        if validate is not None:
+            data = [element for element in data
+                    if not element.get('readings') or validate(element)]
+        filter_ingest.filter_ingest_callback(handle["callback"], handle["ingestRef"], data)
+        _LOGGER.debug(f'{PLUGIN_NAME} filter block ingest done')
+        return
+
     for element in data:
         # need to keep the stuff same to not mess with the North plugin
         # modify only the readings-part
         readings = element.get('readings')
         
         if readings:
-            # go through the json and replace keywords with reading values
-            new_data = replace_pointers(handle['json']['value'], readings)
+            # fill the compiled json of the asset with reading values
+            new_data = route(element.get('asset'))[0](readings, element)
             _LOGGER.debug(f'filtered element {element}')
             element['readings'] = new_data
+            if validate is not None and not validate(element):
+                continue
         # add the modified readings to list
         processed_data.append(element)
 
@@ -169,37 +302,1037 @@ def plugin_ingest(handle, data):
     _LOGGER.debug(f'{PLUGIN_NAME} filter ingest done')
 
 
+def compile_routes(routes, default, compile_route):
+    """ Compile the routes json into a function choosing the route of an asset
+
+    Keys of routes are asset codes, or glob patterns with *, ? or [...].
+    An asset code is looked up from the exact codes first, then the
+    patterns are tried in the order of routes and the first match is used.
+    Assets matching nothing get default. The route of a pattern match is
+    cached by asset code, so each code is matched only once while the cache
+    has room.
+
+    Args:
+        routes:        dict of asset code or pattern to template
+        default:       route for assets matching no key
+        compile_route: function compiling a template into its route
+    Returns:
+        route: function taking an asset code and returning its route
+    """
+    exact = {}
+    patterns = []
+    for key, template in (routes or {}).items():
+        if not isinstance(template, dict):
+            raise ValueError(f'Route {key} is not a json template')
+        if any(char in key for char in '*?['):
+            patterns.append((re.compile(translate(key)).match, compile_route(template)))
+        else:
+            exact[key] = compile_route(template)
+
+    if not patterns:
+        def route_exact(asset):
+            return exact.get(asset, default)
+        return route_exact
+
+    patterns = tuple(patterns)
+    cache = {}
+
+    def route(asset):
+        found = exact.get(asset)
+        if found is not None:
+            return found
+        found = cache.get(asset)
+        if found is not None:
+            return found
+        found = default
+        for match, compiled in patterns:
+            if match(asset or ''):
+                found = compiled
+                break
+        if len(cache) >= _ROUTE_CACHE_SIZE:
+            cache.clear()
+        cache[asset] = found
+        return found
+
+    return route
+
+
 def replace_pointers(config, readings):
-    def replace_keywords(copy_of_config_json):
-        """
-        TODO: use vars instead of hard coded...
-        add format thing...
-        """
-        # try using list to not run into error
-        for key, value in list(copy_of_config_json.items()):
-
-            # if key = "CONFIG", replace that with the "LOCATION" (and "FORMAT")
-            if isinstance(value, dict):
-                if value.get("CONFIG"):
-
-                    # use location to fill the value from readings
-                    # TODO: cannot read values from nested keys
-                    location = value['CONFIG'].get('LOCATION')
-                    _LOGGER.debug(f'Replacing CONFIG with {location}')
-
-                    new_value = readings.get(location)
-                    if new_value:
-                        copy_of_config_json[key] = new_value
-                    else:
-                        copy_of_config_json[key] = "NO VALUE"
-                    _LOGGER.debug(f'It is now: {copy_of_config_json[key]}')
-
-                else: # dig deeper
-                    replace_keywords(value)
-        return copy_of_config_json
-
-    data = deepcopy(config)
-    modified_data = replace_keywords(data)
-
-    return modified_data
+    """ Fill one copy of the config json with values from readings
+
+    Compiles the template on every call, plugin_ingest uses the renderer
+    compiled once in plugin_init and plugin_reconfigure instead.
+    """
+    return compile_template(config)(readings)
+
+
+def compile_template(config, share=False):
+    """ Compile the config json into a renderer
+
+    Every CONFIG node is replaced with the value found at its LOCATION in
+    the readings. The template is walked only here: the renderer knows
+    which keys to fill, copies the constant values of each dict at once and
+    only builds the dicts on the way to a CONFIG node.
+
+    With share, constant dicts and lists are built once and the same
+    read-only objects are put in every reading, see _FrozenDict.
+
+    Args:
+        config: the json template
+        share:  share constant dicts and lists between readings
+    Returns:
+        render: function that takes the readings, and optionally their
+                reading element for UUID5 FIELDS, and returns the new readings
+    """
+    return _compile_dict(config, share=share)
+
+
+def _is_placeholder(value):
+    return isinstance(value, dict) and bool(value.get("CONFIG"))
+
+
+def _is_generator(value):
+    return isinstance(value, dict) and GENERATE_KEY in value
+
+
+def _has_placeholder(value):
+    if _is_placeholder(value) or _is_generator(value):
+        return True
+    if isinstance(value, dict):
+        return any(_has_placeholder(child) for child in value.values())
+    return False
+
+
+def _compile_placeholder(config):
+    """ Compile a CONFIG node into a function reading its value
+
+    LOCATION is a key of the readings, or a nested one like "a.b[0].c".
+    A key of the readings matching the whole LOCATION is used first.
+    FORMAT converts the value, see _compile_format. A missing value, or one
+    that cannot be converted, is filled with NO_VALUE. Only the steps that
+    are configured are compiled in.
+    """
+    location = config.get('LOCATION')
+    get = _compile_location(location)
+    convert = _compile_format(config.get('FORMAT'))
+
+    if convert is None and get is None:
+        # the common case, a plain key of the readings
+        def fill(readings):
+            new_value = readings.get(location)
+            if new_value is None:
+                return NO_VALUE
+            return new_value
+        return fill
+
+    if get is None:
+        def get(readings):
+            return readings.get(location)
+
+    if convert is None:
+        def fill_nested(readings):
+            new_value = get(readings)
+            if new_value is None:
+                return NO_VALUE
+            return new_value
+        return fill_nested
+
+    def fill_and_convert(readings):
+        new_value = get(readings)
+        if new_value is None:
+            return NO_VALUE
+        try:
+            return convert(new_value)
+        except (TypeError, ValueError, OverflowError, OSError):
+            # OSError is raised for epochs out of the platform's range
+            _LOGGER.debug(f'Cannot format {new_value!r} from {location}')
+            return NO_VALUE
+    return fill_and_convert
+
+
+def _compile_raw_placeholder(config):
+    """ Compile a CONFIG node into a function reading its value unconverted """
+    location = config.get('LOCATION')
+    get = _compile_location(location)
+    if get is None:
+        return lambda readings: readings.get(location)
+    return get
+
+
+def _compile_location(location):
+    """ Compile a nested LOCATION into a function reading it from the readings
+
+    Returns None for a plain key, which is read with readings.get directly.
+    """
+    steps = []
+    if isinstance(location, str):
+        pos = 0
+        while pos < len(location):
+            match = _PATH_STEP.match(location, pos)
+            if not match:
+                steps = []
+                break
+            index, key = match.groups()
+            steps.append(int(index) if index is not None else key)
+            pos = match.end()
+
+    if len(steps) <= 1:
+        return None
+
+    steps = tuple(steps)
+
+    def get(readings):
+        value = readings.get(location)
+        if value is not None:
+            return value
+        value = readings
+        try:
+            for step in steps:
+                value = value[step]
+        except (KeyError, IndexError, TypeError):
+            return None
+        return value
+
+    return get
+
+
+def _compile_format(spec):
+    """ Compile a FORMAT into one conversion function, None without FORMAT
+
+    FORMAT is a type name like "float", or a dict with:
+        type:      int, float, str or bool, applied last
+        scale:     multiplier, e.g. 0.001 for W to kW
+        offset:    added after scaling
+        round:     number of decimals
+        timestamp: strftime format, or "iso8601", for the value as timestamp
+        from:      format of the timestamp value: iso8601 (default),
+                   epoch_s or epoch_ms
+    """
+    if not spec:
+        return None
+    if isinstance(spec, str):
+        spec = {'type': spec}
+
+    steps = []
+
+    if 'timestamp' in spec:
+        steps.append(_compile_timestamp(spec['timestamp'], spec.get('from', 'iso8601')))
+
+    scale = spec.get('scale')
+    offset = spec.get('offset')
+    digits = spec.get('round')
+    if scale is not None and offset is not None:
+        steps.append(lambda value: float(value) * scale + offset)
+    elif scale is not None:
+        steps.append(lambda value: float(value) * scale)
+    elif offset is not None:
+        steps.append(lambda value: float(value) + offset)
+    if digits is not None:
+        steps.append(lambda value: round(float(value), int(digits)))
+
+    cast = spec.get('type')
+    if cast:
+        if cast not in _CASTS:
+            raise ValueError(f'Unknown FORMAT type {cast}')
+        steps.append(_CASTS[cast])
+
+    if not steps:
+        return None
+    if len(steps) == 1:
+        return steps[0]
+
+    steps = tuple(steps)
+
+    def convert(value):
+        for step in steps:
+            value = step(value)
+        return value
+    return convert
+
+
+def _numeric_format(spec):
+    """ The FORMAT as dict if block mode can vectorize it, otherwise None """
+    if not spec:
+        return None
+    if isinstance(spec, str):
+        spec = {'type': spec}
+    if 'timestamp' in spec or spec.get('type') not in (None, 'float', 'int'):
+        return None
+    return spec
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def _compile_vector_format(spec):
+    """ Compile a numeric FORMAT into a conversion of a whole column
+
+    The column is converted with NumPy in the same order as _compile_format:
+    scale and offset, round, then the type. NumPy rounds exact halves of the
+    scaled value, so those may differ from round() in the last decimal.
+
+    Returns:
+        convert: function taking a list of values and returning the converted
+                 values and a list telling which of them are valid
+    """
+    scale = spec.get('scale')
+    offset = spec.get('offset')
+    digits = spec.get('round')
+    cast = spec.get('type')
+
+    def convert(column):
+        try:
+            array = np.array(column, dtype=float)
+        except (TypeError, ValueError):
+            array = np.array([_to_float(value) for value in column], dtype=float)
+
+        if scale is not None:
+            array *= scale
+        if offset is not None:
+            array += offset
+        if digits is not None:
+            array = np.round(array, int(digits))
+
+        if cast == 'int':
+            valid = np.isfinite(array)
+            values = np.where(valid, array, 0).astype(np.int64).tolist()
+        else:
+            valid = ~np.isnan(array)
+            values = array.tolist()
+        return values, valid.tolist()
+
+    return convert
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes', 'on')
+    return bool(value)
+
+
+_CASTS = {
+    'int': lambda value: int(float(value)) if isinstance(value, str) else int(value),
+    'float': float,
+    'str': str,
+    'bool': _to_bool
+}
+
+
+def _compile_timestamp(output, source):
+    """ Compile a timestamp conversion, from source format to output format """
+    if source == 'epoch_s':
+        def parse(value):
+            return datetime.fromtimestamp(float(value), tz=timezone.utc)
+    elif source == 'epoch_ms':
+        def parse(value):
+            return datetime.fromtimestamp(float(value) / 1000, tz=timezone.utc)
+    else:
+        def parse(value):
+            if not isinstance(value, str):
+                raise TypeError(f'ISO-8601 timestamp {value!r} is not a string')
+            value = value.strip()
+            if value[-1:] in 'Zz':
+                value = value[:-1] + '+00:00'
+            parsed = datetime.fromisoformat(value)
+            if parsed.tzinfo is None:
+                return parsed.replace(tzinfo=timezone.utc)
+            return parsed.astimezone(timezone.utc)
+
+    if output == 'iso8601':
+        return lambda value: parse(value).isoformat()
+    return lambda value: parse(value).strftime(output)
+
+
+def compile_block_template(config, share=False):
+    """ Compile the config json into a renderer for whole readings blocks
+
+    Works like compile_template, but CONFIG nodes with a numeric FORMAT
+    (scale, offset, round, float or int) are left unconverted while
+    rendering. Their values are then gathered over the block into one NumPy
+    array per CONFIG node, converted with a few array operations and
+    scattered back into the rendered readings.
+
+    Args:
+        config: the json template
+        share:  share constant dicts and lists between readings
+    Returns:
+        render_block: function that takes a list of readings, and optionally
+                      their reading elements, and returns the list of new readings
+    """
+    deferred = []
+    render = _compile_dict(config, (), deferred, share)
+    columns = tuple((path[:-1], path[-1], _compile_vector_format(spec))
+                    for path, spec in deferred)
+
+    def render_block(block, elements=None):
+        if elements is None:
+            outputs = [render(readings) for readings in block]
+        else:
+            outputs = [render(readings, element) for readings, element in zip(block, elements)]
+        for parents, key, convert in columns:
+            targets = outputs
+            for parent in parents:
+                targets = [target[parent] for target in targets]
+            values, valid = convert([target[key] for target in targets])
+            for target, value, is_valid in zip(targets, values, valid):
+                target[key] = value if is_valid else NO_VALUE
+        return outputs
+
+    return render_block
+
+
+def _compile_dict(template, path=(), deferred=None, share=False):
+    """ Compile a dict of the template into a function building a new one
+
+    With deferred, the CONFIG nodes with a numeric FORMAT are filled with
+    their raw value and added to deferred as (path, FORMAT) for block mode.
+    With share, constant dicts and lists are frozen into the base instead
+    of being copied for each reading. Generators and nested dicts are also
+    given the reading element, CONFIG nodes only read the readings.
+    """
+    # constant values are in the base already, in template order
+    base = {}
+    fills = []
+    element_fills = []
+    copies = []
+
+    for key, value in template.items():
+        if _is_placeholder(value):
+            base[key] = None
+            numeric = None
+            if deferred is not None:
+                numeric = _numeric_format(value['CONFIG'].get('FORMAT'))
+            if numeric is not None:
+                fills.append((key, _compile_raw_placeholder(value['CONFIG'])))
+                deferred.append((path + (key,), numeric))
+            else:
+                fills.append((key, _compile_placeholder(value['CONFIG'])))
+        elif _is_generator(value):
+            base[key] = None
+            element_fills.append((key, _compile_generator(value[GENERATE_KEY])))
+        elif isinstance(value, dict) and _has_placeholder(value):
+            # dig deeper
+            base[key] = None
+            element_fills.append((key, _compile_dict(value, path + (key,), deferred, share)))
+        elif isinstance(value, (dict, list)) and share:
+            # built once, every reading refers to the same read-only value
+            base[key] = _freeze_json(value)
+        elif isinstance(value, (dict, list)):
+            # each reading gets its own copy of constant dicts and lists
+            base[key] = None
+            copies.append((key, value))
+        else:
+            base[key] = value
+
+    fills = tuple(fills)
+    element_fills = tuple(element_fills)
+    copies = tuple(copies)
+
+    if not copies:
+        def render(readings, element=None):
+            data = base.copy()
+            for key, fill in fills:
+                data[key] = fill(readings)
+            for key, fill in element_fills:
+                data[key] = fill(readings, element)
+            return data
+        return render
+
+    def render_with_copies(readings, element=None):
+        data = base.copy()
+        for key, fill in fills:
+            data[key] = fill(readings)
+        for key, fill in element_fills:
+            data[key] = fill(readings, element)
+        for key, value in copies:
+            data[key] = _copy_json(value)
+        return data
+    return render_with_copies
+
+
+def _compile_generator(spec):
+    """ Compile a GENERATE node into a function giving a new id
+
+    "uuid4" (or "uuid") is a random version 4 uuid, "uuid7" a time ordered
+    version 7 uuid. {"UUID5": {"FIELDS": [...], "NAMESPACE": ...}} is a
+    name based uuid from the values of the FIELDS, the same for a replayed
+    reading. This does in the template what the add-uuid filter does, so
+    one filter can do both. The function takes the readings and the
+    reading element.
+    """
+    if isinstance(spec, dict) and UUID5_KEY in spec:
+        return _compile_uuid5(spec[UUID5_KEY])
+    kind = spec.strip().lower() if isinstance(spec, str) else ''
+    if kind in ('uuid', 'uuid4'):
+        return _next_uuid4
+    if kind == 'uuid7':
+        return _next_uuid7
+    raise ValueError(f'Unknown GENERATE {spec}')
+
+
+def _compile_uuid5(spec, cache_size=4096):
+    """ Compile a UUID5 spec into a function giving the uuid of a reading
+
+    FIELDS are looked up from the reading element, like "asset" or
+    "timestamp", then at their LOCATION in the readings, as in the add-uuid
+    filter. Their values joined are the name of the uuid5, in NAMESPACE:
+    dns, url (default), oid, x500 or a uuid. The uuids of the last
+    cache_size names are kept.
+    """
+    fields = tuple(spec.get("FIELDS") or ("asset", "timestamp"))
+    getters = tuple((field, _compile_raw_placeholder({'LOCATION': field}))
+                    for field in fields)
+    namespace = spec.get("NAMESPACE", "url")
+    prefix = (_NAMESPACES.get(namespace) or uuid.UUID(namespace)).bytes
+
+    @lru_cache(maxsize=cache_size)
+    def uuid_of(name):
+        # same as str(uuid.uuid5(namespace, name)) without the UUID object
+        raw = bytearray(hashlib.sha1(prefix + name.encode()).digest()[:16])
+        raw[6] = (raw[6] & 0x0f) | 0x50
+        raw[8] = (raw[8] & 0x3f) | 0x80
+        hexed = raw.hex()
+        return f'{hexed[:8]}-{hexed[8:12]}-{hexed[12:16]}-{hexed[16:20]}-{hexed[20:]}'
+
+    def name_based(readings, element=None):
+        values = []
+        for field, get in getters:
+            value = element.get(field) if element is not None else None
+            if value is None:
+                value = get(readings)
+            values.append('' if value is None else str(value))
+        # unit separator, not likely to be in the values
+        return uuid_of('\x1f'.join(values))
+    return name_based
+
+
+# sets the version and variant bits of random bytes, see _uuid4_block
+_VERSION_4 = bytes((byte & 0x0f) | 0x40 for byte in range(256))
+_VARIANT = bytes((byte & 0x3f) | 0x80 for byte in range(256))
+
+
+def _uuid4_block(count):
+    """ count random version 4 uuids as strings
+
+    One read of os.urandom for all of them, the same source uuid.uuid4
+    reads 16 bytes at a time from. The version and variant bits are set
+    for all uuids with two translate calls on the bytes.
+    """
+    raw = bytearray(os.urandom(16 * count))
+    raw[6::16] = raw[6::16].translate(_VERSION_4)
+    raw[8::16] = raw[8::16].translate(_VARIANT)
+    hexed = raw.hex()
+    return [f'{hexed[i:i + 8]}-{hexed[i + 8:i + 12]}-{hexed[i + 12:i + 16]}-'
+            f'{hexed[i + 16:i + 20]}-{hexed[i + 20:i + 32]}'
+            for i in range(0, 32 * count, 32)]
+
+
+def _random_tails(count):
+    """ count random variant and rand_b ends of version 7 uuids """
+    raw = bytearray(os.urandom(8 * count))
+    raw[0::8] = raw[0::8].translate(_VARIANT)
+    hexed = raw.hex()
+    return [f'{hexed[i:i + 4]}-{hexed[i + 4:i + 16]}' for i in range(0, 16 * count, 16)]
+
+
+class _Uuid7Clock:
+    """ Millisecond timestamps and counters for version 7 uuids
+
+    The 12 bit rand_a field of a version 7 uuid is a counter within a
+    millisecond (RFC 9562, method 1), so uuids are ordered also within a
+    block. When the counter runs out, the next millisecond is used. Each
+    plugin module has its own clock, the uuids of one filter are never out
+    of order.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.millis = 0
+        self.counter = 0
+
+    def take(self, count):
+        """ Reserve count uuids, returns the (millisecond, counter) to start from """
+        with self.lock:
+            now = time.time_ns() // 1000000
+            if now > self.millis:
+                self.millis = now
+                self.counter = 0
+            start = (self.millis, self.counter)
+            self.counter += count
+            self.millis += self.counter >> 12
+            self.counter &= 0xfff
+            return start
+
+
+_UUID7_CLOCK = _Uuid7Clock()
+
+
+def _uuid7(millis, counter, tail):
+    """ The version 7 uuid of a millisecond, counter and random tail """
+    stamp = f'{millis:012x}'
+    return f'{stamp[:8]}-{stamp[8:]}-7{counter:03x}-{tail}'
+
+
+def _uuid7_block(count):
+    """ count time ordered version 7 uuids as strings """
+    millis, counter = _UUID7_CLOCK.take(count)
+    uuids = []
+    for tail in _random_tails(count):
+        uuids.append(_uuid7(millis, counter, tail))
+        counter += 1
+        if counter > 0xfff:
+            millis += 1
+            counter = 0
+    return uuids
+
+
+# uuids and tails are made this many at a time from one read of os.urandom
+_UUID_BATCH = 256
+
+
+def _batched(make):
+    """ Function returning the values of make(_UUID_BATCH) one at a time
+
+    Takes the readings and element like other fills, and ignores them.
+    """
+    pending = []
+
+    def take(readings=None, element=None):
+        # list.pop is atomic, so each value is used once also between threads
+        try:
+            return pending.pop()
+        except IndexError:
+            pending.extend(make(_UUID_BATCH))
+            return take()
+    return take
+
+
+_next_uuid4 = _batched(_uuid4_block)
+_next_tail = _batched(_random_tails)
+
+
+def _next_uuid7(readings=None, element=None):
+    # the clock is taken per uuid, a batch made ahead would hold stale times
+    return _uuid7(*_UUID7_CLOCK.take(1), _next_tail())
+
+
+def _copy_json(value):
+    """ Copy of a json value, faster than deepcopy as there are no cycles """
+    if isinstance(value, dict):
+        return {key: _copy_json(child) for key, child in value.items()}
+    if isinstance(value, list):
+        return [_copy_json(child) for child in value]
+    return value
+
+
+def _freeze_json(value):
+    """ Read-only copy of a json value to be shared between readings """
+    if isinstance(value, dict):
+        return _FrozenDict((key, _freeze_json(child)) for key, child in value.items())
+    if isinstance(value, list):
+        return _FrozenList(_freeze_json(child) for child in value)
+    return value
+
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError(f'{PLUGIN_NAME}: constant part of the json is shared '
+                    f'between readings, copy it before modifying')
+
+
+class _FrozenDict(dict):
+    """ dict shared between readings, raises TypeError on modification
+
+    Still a dict for json.dumps and the readings passed onwards. copy() and
+    deepcopy() give a normal, modifiable dict.
+    """
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = __ior__ = _read_only
+
+    def __deepcopy__(self, memo):
+        return _copy_json(self)
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+class _FrozenList(list):
+    """ list shared between readings, raises TypeError on modification """
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def __deepcopy__(self, memo):
+        return _copy_json(self)
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+def compile_policy(schema_validator, policy, dead_letter_asset):
+    """ Compile the policy for invalid readings around a schema validator
+
+    Args:
+        schema_validator: function returning the errors of readings, or None
+        policy:           drop, tag or deadletter
+        dead_letter_asset: asset code of invalid readings for deadletter
+    Returns:
+        validate: function taking an element, returning False if it is to be
+                  dropped, None when there is no schema
+    """
+    if schema_validator is None:
+        return None
+
+    if policy == 'drop':
+        def validate_drop(element):
+            errors = schema_validator(element['readings'])
+            if errors:
+                _LOGGER.debug(f'Dropped {element.get("asset")}: {errors}')
+                return False
+            return True
+        return validate_drop
+
+    if policy == 'deadletter':
+        def validate_dead_letter(element):
+            errors = schema_validator(element['readings'])
+            if errors:
+                element['readings'] = {
+                    "asset": element.get('asset'),
+                    ERRORS_KEY: errors,
+                    "payload": element['readings']
+                }
+                element['asset'] = dead_letter_asset
+            return True
+        return validate_dead_letter
+
+    def validate_tag(element):
+        errors = schema_validator(element['readings'])
+        if errors:
+            element['readings'][ERRORS_KEY] = errors
+        return True
+    return validate_tag
+
+
+def compile_schema(document):
+    """ Compile a JSON Schema into a validator of the transformed readings
+
+    document is a JSON Schema, or an AsyncAPI 2 or 3 document whose first
+    message payload is used. Local references like "#/components/schemas/X" are
+    resolved while compiling. Supported keywords: type, enum, const,
+    properties, required, additionalProperties, items, minItems, maxItems,
+    minimum, maximum, exclusiveMinimum, exclusiveMaximum, minLength,
+    maxLength, pattern, allOf, anyOf and oneOf. Others are ignored.
+
+    Args:
+        document: the schema json, an empty one means no validation
+    Returns:
+        validator: function taking the readings and returning a list of
+                   errors, empty when valid. None without a schema
+    """
+    if not document:
+        return None
+    schema = _schema_payload(document) if 'asyncapi' in document else document
+    if schema is None:
+        raise ValueError('No message payload found in the AsyncAPI document')
+
+    check = _SchemaCompiler(document).compile(schema)
+
+    def validator(readings):
+        errors = []
+        check(readings, '$', errors)
+        return errors
+    return validator
+
+
+def _schema_payload(document):
+    """ The payload schema of the first message of an AsyncAPI document
+
+    AsyncAPI 2 has the messages of a channel in its publish and subscribe
+    operations, AsyncAPI 3 in the messages of the channel.
+    """
+    messages = []
+    for channel in document.get('channels', {}).values():
+        channel = _resolve_ref(document, channel)
+        for operation in ('publish', 'subscribe'):
+            message = channel.get(operation, {}).get('message')
+            if message:
+                messages.append(message)
+        messages.extend(channel.get('messages', {}).values())
+    # messages of the channels come first, in document order
+    messages.extend(document.get('components', {}).get('messages', {}).values())
+    for message in messages:
+        message = _resolve_ref(document, message)
+        for option in message.get('oneOf', [message]):
+            payload = _resolve_ref(document, option).get('payload')
+            if isinstance(payload, dict) and 'schemaFormat' in payload:
+                # AsyncAPI 3 multi format schema
+                payload = payload.get('schema')
+            if payload is not None:
+                return payload
+    return None
+
+
+def _resolve_ref(document, node):
+    """ Follow local $ref of node to the referred part of the document """
+    seen = set()
+    while isinstance(node, dict) and '$ref' in node:
+        ref = node['$ref']
+        if not ref.startswith('#') or ref in seen:
+            raise ValueError(f'Cannot resolve schema reference {ref}')
+        seen.add(ref)
+        node = document
+        for part in ref[1:].split('/'):
+            if part:
+                node = node[part.replace('~1', '/').replace('~0', '~')]
+    return node
+
+
+_NUMBER_TYPES = (int, float)
+
+
+def _is_number(value):
+    # type() is not isinstance, bool is not a number in JSON Schema
+    return type(value) in _NUMBER_TYPES
+
+
+def _is_integer(value):
+    return type(value) is int or (type(value) is float and value.is_integer())
+
+
+_SCHEMA_TYPES = {
+    'object': lambda value: isinstance(value, dict),
+    'array': lambda value: isinstance(value, list),
+    'string': lambda value: isinstance(value, str),
+    'boolean': lambda value: value is True or value is False,
+    'null': lambda value: value is None,
+    'number': _is_number,
+    'integer': _is_integer
+}
+
+
+class _SchemaCompiler:
+    """ Compiles schemas into checks appending errors to a list
+
+    Each check is check(value, path, errors). Only the keywords present in
+    a schema are compiled into its check, and references are compiled once.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self.refs = {}
+
+    def compile(self, schema):
+        if schema is True or schema == {}:
+            return _check_nothing
+        if schema is False:
+            return _check_fail
+        if '$ref' in schema:
+            return self.compile_ref(schema['$ref'])
+
+        checks = []
+        # object and array checks test the type themselves
+        typed = schema.get('type') in ('object', 'array')
+        if 'type' in schema and not typed:
+            checks.append(_check_type(schema['type']))
+        if 'enum' in schema:
+            checks.append(_check_enum(schema['enum']))
+        if 'const' in schema:
+            checks.append(_check_enum([schema['const']]))
+        checks.extend(_check_bounds(schema))
+        if schema.get('type') == 'object' or (not typed and any(
+                key in schema for key in ('properties', 'required', 'additionalProperties'))):
+            checks.append(self.compile_object(schema, typed))
+        if schema.get('type') == 'array' or (not typed and any(
+                key in schema for key in ('items', 'minItems', 'maxItems'))):
+            checks.append(self.compile_array(schema, typed))
+        for keyword in ('allOf', 'anyOf', 'oneOf'):
+            if keyword in schema:
+                checks.append(self.compile_combined(keyword, schema[keyword]))
+
+        if not checks:
+            return _check_nothing
+        if len(checks) == 1:
+            return checks[0]
+        checks = tuple(checks)
+
+        def check_all(value, path, errors):
+            for check in checks:
+                check(value, path, errors)
+        return check_all
+
+    def compile_ref(self, ref):
+        if ref in self.refs:
+            return self.refs[ref]
+        # a reference can refer to itself, compiled one is set below
+        compiled = []
+        self.refs[ref] = lambda value, path, errors: compiled[0](value, path, errors)
+        compiled.append(self.compile(_resolve_ref(self.document, {'$ref': ref})))
+        self.refs[ref] = compiled[0]
+        return compiled[0]
+
+    def compile_object(self, schema, typed):
+        properties = tuple((key, '.' + key, self.compile(child))
+                           for key, child in schema.get('properties', {}).items())
+        required = tuple(schema.get('required', ()))
+        additional = schema.get('additionalProperties', True)
+        known = frozenset(schema.get('properties', {}))
+        check_additional = None
+        if additional is not True:
+            check_additional = self.compile(additional)
+
+        def check_object(value, path, errors):
+            if not isinstance(value, dict):
+                if typed:
+                    errors.append(f'{path}: {value!r} is not object')
+                return
+            for key in required:
+                if key not in value:
+                    errors.append(f'{path}: missing {key}')
+            for key, suffix, check in properties:
+                if key in value:
+                    check(value[key], path + suffix, errors)
+            if check_additional is not None:
+                for key in value:
+                    if key not in known:
+                        check_additional(value[key], f'{path}.{key}', errors)
+        return check_object
+
+    def compile_array(self, schema, typed):
+        items = self.compile(schema.get('items', True))
+        min_items = schema.get('minItems')
+        max_items = schema.get('maxItems')
+
+        def check_array(value, path, errors):
+            if not isinstance(value, list):
+                if typed:
+                    errors.append(f'{path}: {value!r} is not array')
+                return
+            if min_items is not None and len(value) < min_items:
+                errors.append(f'{path}: fewer than {min_items} items')
+            if max_items is not None and len(value) > max_items:
+                errors.append(f'{path}: more than {max_items} items')
+            if items is not _check_nothing:
+                for index, item in enumerate(value):
+                    items(item, f'{path}[{index}]', errors)
+        return check_array
+
+    def compile_combined(self, keyword, schemas):
+        checks = tuple(self.compile(schema) for schema in schemas)
+
+        def count_valid(value, path):
+            return sum(1 for check in checks if not _errors_of(check, value, path))
+
+        if keyword == 'allOf':
+            def check_all_of(value, path, errors):
+                for check in checks:
+                    check(value, path, errors)
+            return check_all_of
+
+        if keyword == 'anyOf':
+            def check_any_of(value, path, errors):
+                if not any(not _errors_of(check, value, path) for check in checks):
+                    errors.append(f'{path}: does not match anyOf')
+            return check_any_of
+
+        def check_one_of(value, path, errors):
+            if count_valid(value, path) != 1:
+                errors.append(f'{path}: does not match exactly one of oneOf')
+        return check_one_of
+
+
+def _errors_of(check, value, path):
+    errors = []
+    check(value, path, errors)
+    return errors
+
+
+def _check_nothing(value, path, errors):
+    pass
+
+
+def _check_fail(value, path, errors):
+    errors.append(f'{path}: not allowed')
+
+
+def _check_type(types):
+    if isinstance(types, str):
+        types = [types]
+    tests = tuple(_SCHEMA_TYPES[name] for name in types)
+    names = '/'.join(types)
+
+    if len(tests) == 1:
+        test = tests[0]
+
+        def check_type(value, path, errors):
+            if not test(value):
+                errors.append(f'{path}: {value!r} is not {names}')
+        return check_type
+
+    def check_types(value, path, errors):
+        if not any(test(value) for test in tests):
+            errors.append(f'{path}: {value!r} is not {names}')
+    return check_types
+
+
+def _json_key(value):
+    """ Hashable key of a JSON value, equal only for equal JSON values
+
+    Unlike with ==, true is not 1 and false is not 0, also inside arrays and
+    objects. 1 and 1.0 are the same number.
+    """
+    if value is True or value is False:
+        return ('boolean', value)
+    if isinstance(value, list):
+        return ('array', tuple(_json_key(item) for item in value))
+    if isinstance(value, dict):
+        return ('object', frozenset((key, _json_key(item)) for key, item in value.items()))
+    return value
+
+
+def _check_enum(options):
+    allowed = frozenset(_json_key(option) for option in options)
+
+    def check_enum(value, path, errors):
+        if _json_key(value) not in allowed:
+            errors.append(f'{path}: {value!r} is not one of {options}')
+    return check_enum
+
+
+def _check_bounds(schema):
+    """ Checks of the number and string keywords of schema """
+    checks = []
+    for keyword, fails, text in (
+            ('minimum', lambda value, bound: value < bound, 'less than'),
+            ('maximum', lambda value, bound: value > bound, 'more than'),
+            ('exclusiveMinimum', lambda value, bound: value <= bound, 'not more than'),
+            ('exclusiveMaximum', lambda value, bound: value >= bound, 'not less than')):
+        bound = schema.get(keyword)
+        if _is_number(bound):
+            checks.append(_check_number(fails, bound, text))
+
+    min_length = schema.get('minLength')
+    max_length = schema.get('maxLength')
+    pattern = schema.get('pattern')
+    if min_length is not None or max_length is not None or pattern is not None:
+        search = re.compile(pattern).search if pattern is not None else None
+
+        def check_string(value, path, errors):
+            if not isinstance(value, str):
+                return
+            if min_length is not None and len(value) < min_length:
+                errors.append(f'{path}: shorter than {min_length}')
+            if max_length is not None and len(value) > max_length:
+                errors.append(f'{path}: longer than {max_length}')
+            if search is not None and not search(value):
+                errors.append(f'{path}: does not match {pattern}')
+        checks.append(check_string)
+    return checks
+
 
+def _check_number(fails, bound, text):
+    def check_number(value, path, errors):
+        if _is_number(value) and fails(value, bound):
+            errors.append(f'{path}: {value!r} is {text} {bound}')
+    return check_number
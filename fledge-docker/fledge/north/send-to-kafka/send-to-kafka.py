@@ -13,15 +13,36 @@ For Fledge v2.4.0
 
 
 import asyncio
+from fnmatch import translate
+import hashlib
+import io
 import json
+import os
+import queue
+import re
+import threading
 
 from copy import deepcopy
 
 from kafka import KafkaProducer
 from fledge.common import logger
 
+# optional serializers, plugin_init fails when the selected one is missing
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import fastavro
+except ImportError:
+    fastavro = None
+
 _LOGGER = logger.setup(__name__)
 
+# routed asset codes remembered, the cache is cleared when full
+_ROUTE_CACHE_SIZE = 4096
+
 PLUGIN_NAME = 'send-to-kafka'
 
 _DEFAULT_CONFIG = {
@@ -61,6 +82,127 @@ _DEFAULT_CONFIG = {
          'options': ['readings', 'statistics'],
          'order': '3',
          'displayName': 'Source'
+    },
+
+    'maxInFlight': {
+        'description': 'Maximum number of records sent and not yet acknowledged by Kafka',
+        'type': 'integer',
+        'default': '1000',
+        'order': '4',
+        'displayName': 'Max in flight'
+    },
+
+    'ackTimeout': {
+        'description': 'Seconds to wait for Kafka to acknowledge the records of a block',
+        'type': 'float',
+        'default': '30',
+        'order': '5',
+        'displayName': 'Acknowledgement timeout'
+    },
+
+    'sendMode': {
+        'description': 'Call the producer in the event loop (inline), or hand the records '
+                       'to a sender thread so a full buffer or a metadata fetch '
+                       'cannot block the loop (thread)',
+        'type': 'enumeration',
+        'default': 'inline',
+        'options': ['inline', 'thread'],
+        'order': '6',
+        'displayName': 'Send mode'
+    },
+
+    'envelope': {
+        'description': 'Pack many readings of an asset in one Kafka record, '
+                       'as a JSON array',
+        'type': 'boolean',
+        'default': 'false',
+        'order': '7',
+        'displayName': 'Envelope'
+    },
+
+    'envelopeReadings': {
+        'description': 'Maximum number of readings in one envelope',
+        'type': 'integer',
+        'default': '100',
+        'order': '8',
+        'displayName': 'Envelope readings'
+    },
+
+    'envelopeBytes': {
+        'description': 'Maximum size of one envelope in bytes, a larger reading is sent alone',
+        'type': 'integer',
+        'default': '65536',
+        'order': '9',
+        'displayName': 'Envelope bytes'
+    },
+
+    'serializer': {
+        'description': 'Encoding of the readings: json, compact json, MessagePack '
+                       '(needs msgpack) or Avro (needs fastavro)',
+        'type': 'enumeration',
+        'default': 'json',
+        'options': ['json', 'json-compact', 'msgpack', 'avro'],
+        'order': '10',
+        'displayName': 'Serializer'
+    },
+
+    'avroSchema': {
+        'description': 'Avro schema of one reading, the default fits the readings of '
+                       'the default transform-to-asyncapi template: a data object '
+                       'of numbers, strings and booleans',
+        'type': 'JSON',
+        'default': json.dumps({
+            "type": "record",
+            "name": "MeasurementMessage",
+            "namespace": "fledge.asyncapi",
+            "fields": [
+                {"name": "data", "type": {
+                    "type": "map",
+                    "values": ["null", "boolean", "long", "double", "string"]
+                }}
+            ]
+        }),
+        'order': '11',
+        'displayName': 'Avro schema'
+    },
+
+    'schemaRegistry': {
+        'description': 'Directory of the local Avro schema registry, '
+                       'default is kafka-schemas in the Fledge data directory',
+        'type': 'string',
+        'default': '',
+        'order': '12',
+        'displayName': 'Schema registry directory'
+    },
+
+    'topicRoutes': {
+        'description': 'Topics per asset code, keys are asset codes or glob patterns '
+                       'like "meter_*", others are sent to topic',
+        'type': 'JSON',
+        'default': json.dumps({}),
+        'order': '13',
+        'displayName': 'Topic routes'
+    },
+
+    'partitionKey': {
+        'description': 'Key of the records, Kafka chooses the partition by it: the asset '
+                       'code, the partition fields, a hash of the partition fields, or '
+                       'none to spread the records over the partitions',
+        'type': 'enumeration',
+        'default': 'asset',
+        'options': ['asset', 'field', 'hash', 'none'],
+        'order': '14',
+        'displayName': 'Partition key'
+    },
+
+    'partitionFields': {
+        'description': 'Comma separated fields of the reading for the partition key, '
+                       'asset for the asset code and / for nested fields, e.g. '
+                       'asset,data/IdentifiedObject.mRID',
+        'type': 'string',
+        'default': 'asset',
+        'order': '15',
+        'displayName': 'Partition fields'
     }
 }
 
@@ -101,13 +243,30 @@ def plugin_init(data):
         data: plugin configuration
     Returns:
         handle: dictionary of a Plugin configuration
+    Raises:
+        ValueError: the serializer is not available, see make_serializer
 
     """
     handle = deepcopy(data)
 
     # pass the json to the KafkaProducer
     config = handle['configuration']['value']
-    handle['plugin'] = KafkaPlugin(**config)
+    handle['plugin'] = KafkaPlugin(
+        max_in_flight=int(handle['maxInFlight']['value']),
+        ack_timeout=float(handle['ackTimeout']['value']),
+        send_mode=handle['sendMode']['value'],
+        envelope_readings=(int(handle['envelopeReadings']['value'])
+                           if handle['envelope']['value'] == 'true' else 0),
+        envelope_bytes=int(handle['envelopeBytes']['value']),
+        serializer=handle['serializer']['value'],
+        avro_schema=handle['avroSchema']['value'],
+        schema_registry=handle['schemaRegistry']['value'],
+        topic=handle['topic']['value'],
+        topic_routes=handle['topicRoutes']['value'],
+        partition_key=handle['partitionKey']['value'],
+        partition_fields=[field.strip() for field in
+                          handle['partitionFields']['value'].split(',') if field.strip()],
+        **config)
  
     _LOGGER.debug(f'Init, handle: {handle}')
 
@@ -171,8 +330,6 @@ def plugin_shutdown(handle):
     Returns:
 
     """
-    # should work without flushing
-    # handle['plugin'].flush()
     handle['plugin'].close()
     handle['plugin'] = None
 
@@ -187,15 +344,44 @@ class KafkaPlugin(object):
     This class wraps the sending of the payload
     """
 
-    def __init__(self, **config):
+    def __init__(self, max_in_flight=1000, ack_timeout=30.0, send_mode='inline',
+                 envelope_readings=0, envelope_bytes=65536, serializer='json',
+                 avro_schema=None, schema_registry='', topic='Fledge', topic_routes=None,
+                 partition_key='asset', partition_fields=(), **config):
         """
         Initialize producer with values from json
 
         Args: 
+            max_in_flight: records sent and not yet acknowledged at most
+            ack_timeout: seconds to wait for the acknowledgements of a block
+            send_mode: inline, or thread to send from a _SenderThread
+            envelope_readings: readings per record at most, 0 for one
+                               reading per record without an envelope
+            envelope_bytes: size of an envelope at most
+            serializer: name of the serializer, see make_serializer
+            avro_schema: schema of a reading for avro
+            schema_registry: directory of the local schema registry for avro
+            topic: topic of the readings without a topic route
+            topic_routes: dict of asset code or pattern to topic
+            partition_key: asset, field, hash or none, see _compile_partition_key
+            partition_fields: fields of the reading for field and hash
             config: configuration to KafkaProducer
         Returns:
 
         """
+        self.max_in_flight = max(1, max_in_flight)
+        self.ack_timeout = ack_timeout
+        self.envelope_readings = envelope_readings
+        self.envelope_bytes = envelope_bytes
+
+        # a serializer that cannot be made fails the plugin, the records
+        # are not sent in another format than the consumers expect
+        topic_routes = topic_routes or {}
+        topics = [topic] + sorted(set(topic_routes.values()))
+        self.serializer = make_serializer(
+            serializer, avro_schema, schema_registry,
+            [f'{name}-value' for name in topics], envelope=envelope_readings > 0)
+
         try:
             self.producer = KafkaProducer(**config)
 
@@ -207,14 +393,37 @@ class KafkaPlugin(object):
             self.producer = None
 
         # set topic
-        # TODO: hardcoded now, could be in config
-        self.topic = 'Fledge'
+        self.topic = topic
+        self.route = _compile_routing(topic, topic_routes,
+                                      _compile_partition_key(partition_key, partition_fields))
+
+        self.sender = None
+        if self.producer and send_mode == 'thread':
+            self.sender = _SenderThread(self.producer)
       
+    def close(self):
+        """Send the records still buffered and close the producer"""
+        if self.sender:
+            self.sender.stop()
+            self.sender = None
+        if self.producer:
+            try:
+                self.producer.flush(timeout=self.ack_timeout)
+            except Exception as exc:
+                _LOGGER.error(f'Flushing before close failed: {exc}')
+            self.producer.close()
+            self.producer = None
+
     async def send_payloads(self, payloads):
         """Parse the payloads and send them
 
-        Go through the list, transform to json.
-        Send every reading on its own, at the end flush.
+        Go through the list, transform to json and send every reading on its
+        own, or in envelopes of many readings, see _envelopes. Up to
+        max_in_flight records are sent ahead of the acknowledgements from
+        Kafka, which are awaited without blocking the event loop. A reading
+        counts as sent only when it and all readings before it have been
+        acknowledged, so Fledge sends the rest again and nothing is lost
+        (at least once).
 
         Args:
             payloads: list of readings, each is a dict with:
@@ -226,8 +435,9 @@ class KafkaPlugin(object):
 
         Return:
             is_data_sent: has _any_ data been sent
-            last_object_id: object id of the last reading which has been sent
-            num_sent: total number of readings which has been sent
+            last_object_id: object id of the last acknowledged reading, with
+                            all before it acknowledged too
+            num_sent: total number of readings acknowledged
 
         """
         is_data_sent = False
@@ -235,65 +445,522 @@ class KafkaPlugin(object):
         num_sent = 0
 
         kafka = self.producer
+        sender = self.sender
+        loop = asyncio.get_event_loop()
+        # created here, for the loop running the send
+        window = asyncio.Semaphore(self.max_in_flight)
+        # the future of the record of each reading id
+        pending = {}
+
+        if self.envelope_readings > 0:
+            records = _envelopes(payloads, self.route, self.serializer,
+                                 self.envelope_readings, self.envelope_bytes)
+        else:
+            records = _records(payloads, self.route, self.serializer)
 
+        def release(_):
+            window.release()
 
-        def on_send_error(error):
-            _LOGGER.error(f'Kafka error: {error}')
-
-
-        def on_send_success(record_metadata):
-            """
-                https://kafka-python.readthedocs.io/en/master/usage.html#kafkaproducer
-            """
-            _LOGGER.debug(f'topic: {record_metadata.topic}')
-            _LOGGER.debug(f'partition: {record_metadata.partition}')
-            _LOGGER.debug(f'offset: {record_metadata.offset}')
-
-        def parse_and_send(payloadToSend):
-            """Format and send one payload
+        def send(topic, key, value):
+            """Send one record
 
-            Use asset as the key, so that the order stays correct in kafka.
-            Kafka chooses partitions based on key, so if key is not the same
-            when sending data for same thing the order might change..
+            The key is the asset by default, so that the order stays correct
+            in kafka. Kafka chooses partitions based on key, so if key is not
+            the same when sending data for same thing the order might change..
             
             Args:
-                payload: an item from the payloads list
+                topic: topic of the record
+                key: partition key of the readings, or None
+                value: the encoded record
             Return:
+                acked: asyncio future done when Kafka has acknowledged the record
 
             """
+            acked = loop.create_future()
+            acked.add_done_callback(release)
 
-            # TODO: is parsing needed?
-            _LOGGER.debug(f'Payload: {payloadToSend}')
-            value = json.dumps(payloadToSend['reading']).encode('utf-8')
-            key = payloadToSend['asset_code']
-
-            kafka.send(
-                topic=self.topic,
-                key=key.encode(),
-                value=value
-                ).add_callback(on_send_success).add_errback(on_send_error)
-    
+            if sender:
+                # the sender thread calls kafka, the loop only queues the record
+                sender.submit(loop, topic, key, value, acked)
+            else:
+                _send(kafka, loop, topic, key, value, acked)
+            return acked
 
         try:
-            for payload in payloads:
+            while True:
+                # records are encoded as they are taken, a reading that
+                # cannot be routed or encoded ends the send like a failed one
+                try:
+                    record = next(records, None)
+                except Exception as exc:
+                    _LOGGER.error(f'Error encoding readings: {exc}')
+                    break
+                if record is None:
+                    break
+                topic, key, value, object_ids = record
+
+                # wait for room in the window of records in flight
+                try:
+                    await asyncio.wait_for(window.acquire(), self.ack_timeout)
+                except asyncio.TimeoutError:
+                    _LOGGER.info(f'No acknowledgements from Kafka in {self.ack_timeout} s')
+                    break
                 try:
-                    parse_and_send(payload)
+                    acked = send(topic, key, value)
                 
                 except Exception as exc:
                     # if sending was not successful, simply stop sending (return the status)
+                    window.release()
                     _LOGGER.info(f'Error with sending: {exc}')
                     break
 
-                # has _any_ data been sent?
-                else:
-                    is_data_sent = True
-                    last_object_id = payload['id']
-                    _LOGGER.debug(f'Last sent: {last_object_id}')
-                    num_sent += 1
-            
+                for object_id in object_ids:
+                    pending[object_id] = acked
+
         # TODO: general exception...
         except Exception as exc:
             _LOGGER.exception(f'Error in sending payloads: {exc}')
 
+        if pending:
+            # the records already sent are awaited also when sending stopped
+            await asyncio.wait(set(pending.values()), timeout=self.ack_timeout)
+
+        # report the acknowledged readings up to the first one that is not
+        contiguous = True
+        for payload in payloads:
+            object_id = payload['id']
+            acked = pending.get(object_id)
+            if acked is None:
+                # not sent
+                contiguous = False
+            elif not acked.done():
+                if contiguous:
+                    _LOGGER.info(f'No acknowledgement for {object_id} in {self.ack_timeout} s')
+                acked.cancel()
+                contiguous = False
+            elif acked.cancelled() or acked.exception():
+                if contiguous:
+                    _LOGGER.error(f'Kafka error: {acked.exception()}')
+                contiguous = False
+            elif contiguous:
+                is_data_sent = True
+                last_object_id = object_id
+                num_sent += 1
+
+        _LOGGER.debug(f'Last sent: {last_object_id}')
+
         # return in both cases
         return is_data_sent, last_object_id, num_sent
+
+
+def _records(payloads, route, serializer):
+    """One record per reading, (topic, key, encoded reading, (id,))"""
+    encode = serializer.encode
+    for payload in payloads:
+        _LOGGER.debug(f'Payload: {payload}')
+        yield route(payload) + (encode(payload['reading']), (payload['id'],))
+
+
+def _envelopes(payloads, route, serializer, max_readings, max_bytes):
+    """Records of many readings of one topic and key, (topic, key, envelope, ids)
+
+    An envelope is an array of the readings of one topic and key, by default
+    of one asset, in the order of the payloads, framed by the serializer,
+    e.g. [{...},{...}] with json. It is sent when it has max_readings
+    readings, when the next reading would make it larger than max_bytes, or
+    at the end of the payloads. The key is the key of the record like
+    without envelopes, so the envelopes of a key, and the readings in them,
+    stay in order. A reading that cannot be routed or encoded raises after
+    the open envelopes, which hold only readings before it, are given.
+    """
+    encode = serializer.encode_item
+    pack = serializer.pack
+    # bytes of the framing for the envelope, and for each reading in it
+    base, per_item = serializer.envelope_base, serializer.envelope_item
+    # (topic, key): (encoded readings, size of the envelope, ids)
+    open_envelopes = {}
+
+    for payload in payloads:
+        _LOGGER.debug(f'Payload: {payload}')
+        try:
+            destination = route(payload)
+            value = encode(payload['reading'])
+        except Exception:
+            for destination, envelope in open_envelopes.items():
+                yield destination + (pack(envelope[0]), envelope[2])
+            raise
+        envelope = open_envelopes.get(destination)
+        if envelope is not None and (len(envelope[0]) >= max_readings
+                                     or envelope[1] + per_item + len(value) > max_bytes):
+            del open_envelopes[destination]
+            yield destination + (pack(envelope[0]), envelope[2])
+            envelope = None
+        if envelope is None:
+            open_envelopes[destination] = [[value], base + len(value), [payload['id']]]
+        else:
+            envelope[0].append(value)
+            envelope[1] += per_item + len(value)
+            envelope[2].append(payload['id'])
+
+    for destination, envelope in open_envelopes.items():
+        yield destination + (pack(envelope[0]), envelope[2])
+
+
+def _compile_routing(topic, topic_routes, partition_key):
+    """Compile the topic routes into a function giving the topic and key of a reading
+
+    Keys of topic_routes are asset codes, or glob patterns with *, ? or
+    [...]. The exact codes are looked up first, then the patterns are tried
+    in the order of topic_routes and the first match is used. Assets
+    matching nothing go to topic. The topic of an asset code is cached, so
+    each code is matched only once while the cache has room.
+
+    Args:
+        topic: topic of the readings without a route
+        topic_routes: dict of asset code or pattern to topic
+        partition_key: function giving the key of a reading
+    Returns:
+        route: function taking a payload and returning (topic, key)
+    """
+    exact = {}
+    patterns = []
+    for asset, routed in topic_routes.items():
+        if any(char in asset for char in '*?['):
+            patterns.append((re.compile(translate(asset)).match, routed))
+        else:
+            exact[asset] = routed
+    patterns = tuple(patterns)
+    cache = {}
+
+    def topic_of(asset):
+        found = exact.get(asset)
+        if found is not None:
+            return found
+        found = cache.get(asset)
+        if found is not None:
+            return found
+        found = topic
+        for match, routed in patterns:
+            if match(asset):
+                found = routed
+                break
+        if len(cache) >= _ROUTE_CACHE_SIZE:
+            cache.clear()
+        cache[asset] = found
+        return found
+
+    if not exact and not patterns:
+        def route_default(payload):
+            return topic, partition_key(payload)
+        return route_default
+
+    def route(payload):
+        return topic_of(payload['asset_code']), partition_key(payload)
+    return route
+
+
+def _compile_partition_key(strategy, fields):
+    """Compile a partition key strategy into a function giving the key of a reading
+
+    Args:
+        strategy: asset for the asset code, field for the values of fields
+                  joined with |, hash for 8 bytes of blake2b of them, none for
+                  no key, Kafka then spreads the records over the partitions
+        fields: field names of the reading, asset for the asset code and
+                / between the keys of nested fields
+    Returns:
+        partition_key: function taking a payload and returning the key bytes
+    """
+    if strategy == 'none':
+        return lambda payload: None
+    if strategy == 'asset' or not fields:
+        if strategy != 'asset':
+            _LOGGER.warning(f'No partition fields for {strategy}, using the asset as key')
+        return lambda payload: payload['asset_code'].encode()
+
+    getters = tuple(_compile_field(field) for field in fields)
+
+    def joined(payload):
+        return '|'.join(str(get(payload)) for get in getters).encode()
+
+    if strategy == 'hash':
+        def hashed(payload):
+            return hashlib.blake2b(joined(payload), digest_size=8).digest()
+        return hashed
+    return joined
+
+
+def _compile_field(field):
+    """Function giving a field of a payload, '' when it is missing"""
+    if field == 'asset':
+        return lambda payload: payload['asset_code']
+    steps = tuple(field.split('/'))
+    if len(steps) == 1:
+        return lambda payload: payload['reading'].get(field, '')
+
+    def get(payload):
+        value = payload['reading']
+        for step in steps:
+            if not isinstance(value, dict):
+                return ''
+            value = value.get(step, '')
+        return value
+    return get
+
+
+def make_serializer(name, avro_schema=None, schema_registry='', subjects=('Fledge-value',),
+                    envelope=False):
+    """Serializer of readings by name
+
+    A serializer has encode(reading) returning the bytes of a record,
+    encode_item(reading) returning the bytes of a reading in an envelope,
+    pack(encoded readings) returning the bytes of an envelope, and the
+    framing sizes envelope_base and envelope_item of an envelope.
+
+    Args:
+        name: json, json-compact, msgpack or avro
+        avro_schema: schema of one reading for avro
+        schema_registry: directory of the _LocalSchemaRegistry for avro
+        subjects: registry subjects of the schema for avro, one per topic
+        envelope: register the schema of an envelope of readings for avro
+    Returns:
+        serializer
+    Raises:
+        ValueError: unknown serializer, its module is not installed, or
+                    avro without a schema
+    """
+    if name == 'json':
+        return _JsonSerializer()
+    if name == 'json-compact':
+        return _JsonSerializer(compact=True)
+    if name == 'msgpack':
+        if msgpack is None:
+            raise ValueError('msgpack is not installed')
+        return _MsgpackSerializer()
+    if name == 'avro':
+        if fastavro is None:
+            raise ValueError('fastavro is not installed')
+        if not avro_schema:
+            raise ValueError('avro needs an avroSchema')
+        directory = schema_registry or os.path.join(
+            os.getenv('FLEDGE_DATA', '.'), 'kafka-schemas')
+        return _AvroSerializer(avro_schema, _LocalSchemaRegistry(directory), subjects, envelope)
+    raise ValueError(f'Unknown serializer {name}')
+
+
+class _JsonSerializer(object):
+    """
+    UTF-8 JSON, as json.dumps, or compact without the spaces
+    An envelope is a JSON array: [reading,reading]
+    """
+
+    envelope_base = 2
+    envelope_item = 1
+
+    def __init__(self, compact=False):
+        separators = (',', ':') if compact else None
+        self.dumps = json.JSONEncoder(separators=separators).encode
+
+    def encode(self, reading):
+        return self.dumps(reading).encode('utf-8')
+
+    encode_item = encode
+
+    def pack(self, encoded):
+        return b'[' + b','.join(encoded) + b']'
+
+
+class _MsgpackSerializer(object):
+    """
+    MessagePack, an envelope is a MessagePack array of the readings
+    """
+
+    # array header at most
+    envelope_base = 5
+    envelope_item = 0
+
+    def __init__(self):
+        self.packer = msgpack.Packer(use_bin_type=True)
+
+    def encode(self, reading):
+        return self.packer.pack(reading)
+
+    encode_item = encode
+
+    def pack(self, encoded):
+        return self.packer.pack_array_header(len(encoded)) + b''.join(encoded)
+
+
+class _AvroSerializer(object):
+    """
+    Avro binary with the framing of the Confluent schema registry:
+    a zero byte, the schema id as 4 byte big endian integer, and the record.
+    An envelope is an Avro array of the readings, with the id of the array
+    schema. The schemas are registered in the _LocalSchemaRegistry.
+    """
+
+    # magic byte, schema id, item count and the end of the array at most
+    envelope_base = 5 + 10 + 1
+    envelope_item = 0
+
+    def __init__(self, schema, registry, subjects, envelope):
+        self.schema = fastavro.parse_schema(schema)
+        self.write = fastavro.schemaless_writer
+        # only the schema used is registered
+        if envelope:
+            schema = {'type': 'array', 'items': schema}
+        # the same schema has the same id in every subject
+        schema_ids = {registry.register(subject, schema) for subject in subjects}
+        self.header = _confluent_header(schema_ids.pop())
+
+    def encode(self, reading):
+        output = io.BytesIO()
+        output.write(self.header)
+        self.write(output, self.schema, reading)
+        return output.getvalue()
+
+    def encode_item(self, reading):
+        output = io.BytesIO()
+        self.write(output, self.schema, reading)
+        return output.getvalue()
+
+    def pack(self, encoded):
+        # one block of len(encoded) items, then the empty block ending the array
+        return self.header + _avro_long(len(encoded)) + b''.join(encoded) + b'\x00'
+
+
+def _confluent_header(schema_id):
+    return b'\x00' + schema_id.to_bytes(4, 'big')
+
+
+def _avro_long(value):
+    """Avro encoding of a long, zigzag and variable length"""
+    value = (value << 1) ^ (value >> 63)
+    encoded = bytearray()
+    while value & ~0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+class _LocalSchemaRegistry(object):
+    """
+    File backed stand-in for a schema registry
+
+    Each schema is <id>.avsc in the directory, and subjects.json lists the
+    schema ids of each subject. Consumers read the schema of a record from
+    <id>.avsc, by the id in the record header. Registering the same schema
+    again gives its existing id.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def register(self, subject, schema):
+        """Id of schema, registered under subject"""
+        canonical = json.dumps(schema, sort_keys=True, separators=(',', ':'))
+        subjects = self._read('subjects.json', {})
+        ids = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.avsc') and name[:-5].isdigit():
+                ids.append(int(name[:-5]))
+                with open(os.path.join(self.directory, name)) as schema_file:
+                    if schema_file.read() == canonical:
+                        schema_id = int(name[:-5])
+                        break
+        else:
+            schema_id = max(ids, default=0) + 1
+            self._write(f'{schema_id}.avsc', canonical)
+
+        if schema_id not in subjects.get(subject, []):
+            subjects.setdefault(subject, []).append(schema_id)
+            self._write('subjects.json', json.dumps(subjects, indent=2))
+        return schema_id
+
+    def _read(self, name, default):
+        try:
+            with open(os.path.join(self.directory, name)) as registry_file:
+                return json.load(registry_file)
+        except FileNotFoundError:
+            return default
+
+    def _write(self, name, content):
+        # replace the file at once, a reader never sees half of it
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'w') as registry_file:
+            registry_file.write(content)
+        os.replace(path + '.tmp', path)
+
+
+def _send(kafka, loop, topic, key, value, acked):
+    """Send one record, acked gets the result of kafka in the loop"""
+    # kafka calls back from its own thread, hand the result to the loop
+    kafka.send(
+        topic=topic,
+        key=key,
+        value=value
+        ).add_callback(_call_in_loop, loop, _resolve, acked
+        ).add_errback(_call_in_loop, loop, _reject, acked)
+
+
+class _SenderThread(object):
+    """
+    Thread calling KafkaProducer.send for the event loop
+
+    KafkaProducer.send blocks for up to max_block_ms when its buffer is full
+    or while it fetches metadata. Here that blocks only this thread, the
+    loop just puts the records in a queue. The queue is not bounded, the
+    window of send_payloads limits the records in it.
+    """
+
+    def __init__(self, producer):
+        self.producer = producer
+        self.records = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name=f'{PLUGIN_NAME}-sender', daemon=True)
+        self.thread.start()
+
+    def submit(self, loop, topic, key, value, acked):
+        self.records.put_nowait((loop, topic, key, value, acked))
+
+    def run(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                return
+            loop, topic, key, value, acked = record
+            try:
+                _send(self.producer, loop, topic, key, value, acked)
+            except Exception as exc:
+                _LOGGER.info(f'Error with sending: {exc}')
+                _call_in_loop(loop, _reject, acked, exc)
+
+    def stop(self):
+        """Send the records in the queue, then stop the thread"""
+        self.records.put(None)
+        self.thread.join()
+
+
+def _call_in_loop(loop, function, future, result):
+    """Call function(future, result) in the loop, from the thread of kafka"""
+    try:
+        loop.call_soon_threadsafe(function, future, result)
+    except RuntimeError:
+        # the loop is closed, nobody waits for the result anymore
+        pass
+
+
+def _resolve(future, record_metadata):
+    """
+        https://kafka-python.readthedocs.io/en/master/usage.html#kafkaproducer
+    """
+    if not future.done():
+        _LOGGER.debug(f'topic: {record_metadata.topic}, partition: {record_metadata.partition}, '
+                      f'offset: {record_metadata.offset}')
+        future.set_result(record_metadata)
+
+
+def _reject(future, error):
+    if not future.done():
+        future.set_exception(error)
@@ -12,9 +12,18 @@ For Fledge v2.4.0
 
 import copy
 import asyncio
+import calendar
+import codecs
+import email.utils
+import hashlib
 import json
 import logging
+import math
+import random
+import re
+import time
 from threading import Thread
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
 import aiohttp
 from datetime import datetime, timezone
 
@@ -25,6 +34,22 @@ _LOGGER = logger.setup(__name__, level=logging.DEBUG)
 
 PLUGIN_NAME = 'get-from-rest'
 
+# seconds to wait for the session to close when shutting down
+_SHUTDOWN_TIMEOUT = 5
+
+_NO_VALIDATORS = {'etag': None, 'last_modified': None, 'digest': None}
+
+_MISSING = object()
+
+# statuses that make an endpoint back off, like a failed request
+_RETRY_STATUSES = (429, 503)
+
+# key of a streaming spec that selects every element of the records array
+_ITEMS = object()
+
+# step of a compiled location that selects every element
+_WILDCARD = object()
+
 _DEFAULT_CONFIG = {
     'plugin': {
         'description': 'GET data from REST APIs',
@@ -58,7 +83,8 @@ _DEFAULT_CONFIG = {
     },
 
     'wrapper': {
-        'description': 'JSON defining key name and location in data',
+        'description': 'JSON defining key name and location in data, locations can '
+                       'be nested like "data.items[0].value" or "data.items[*].value"',
         'type': 'JSON',
         'default': json.dumps({
             'datasetId': 'datasetId',
@@ -75,6 +101,200 @@ _DEFAULT_CONFIG = {
         'default': '10',
         'displayName': 'Interval between calls in secs',
         'mandatory': 'false'
+    },
+
+    'endpoints': {
+        'description': 'List of endpoints as JSON, each with url, headers, '
+                       'wrapper, assetName, interval, maxInFlight, records, '
+                       'pagination, maxPages, timestamp and timestampFormat. Missing '
+                       'keys use the values above. Empty list polls only the URL above',
+        'type': 'JSON',
+        'default': json.dumps([]),
+        'displayName': 'Endpoints',
+        'mandatory': 'false'
+    },
+
+    'maxConcurrent': {
+        'description': 'Maximum number of requests in flight over all endpoints',
+        'type': 'integer',
+        'default': '20',
+        'displayName': 'Max concurrent requests',
+        'mandatory': 'false'
+    },
+
+    'maxInFlight': {
+        'description': 'Maximum number of polls in flight per endpoint, '
+                       'a tick is missed while the limit is reached',
+        'type': 'integer',
+        'default': '1',
+        'displayName': 'Max polls in flight per endpoint',
+        'mandatory': 'false'
+    },
+
+    'maxBackoff': {
+        'description': 'Upper limit in seconds for the exponential backoff '
+                       'after failures and 429/503 responses',
+        'type': 'integer',
+        'default': '300',
+        'displayName': 'Max backoff in secs',
+        'mandatory': 'false'
+    },
+
+    'lateTolerance': {
+        'description': 'Seconds a tick may start after its wall-clock time '
+                       'before it is reported late',
+        'type': 'float',
+        'default': '0.5',
+        'displayName': 'Late tick tolerance in secs',
+        'mandatory': 'false'
+    },
+
+    'records': {
+        'description': 'Location of the array of measurements in the response, '
+                       'every element is mapped through the wrapper. Empty reads '
+                       'one object, or every element if the response is an array',
+        'type': 'string',
+        'default': '',
+        'displayName': 'Records location',
+        'mandatory': 'false'
+    },
+
+    'pagination': {
+        'description': 'Pagination as JSON: {"next": "links.next"} follows a next link, '
+                       '{"cursor": "meta.cursor", "param": "cursor"} sends the cursor '
+                       'as query parameter. Empty reads only one page',
+        'type': 'JSON',
+        'default': json.dumps({}),
+        'displayName': 'Pagination',
+        'mandatory': 'false'
+    },
+
+    'maxPages': {
+        'description': 'Maximum number of pages read per poll',
+        'type': 'integer',
+        'default': '10',
+        'displayName': 'Max pages per poll',
+        'mandatory': 'false'
+    },
+
+    'timestamp': {
+        'description': 'Location of the source timestamp in each record, '
+                       'empty uses the time of the poll, as do records whose '
+                       'timestamp is missing or cannot be parsed',
+        'type': 'string',
+        'default': '',
+        'displayName': 'Timestamp location',
+        'mandatory': 'false'
+    },
+
+    'timestampFormat': {
+        'description': 'Format of the source timestamp: iso8601, epoch_s, epoch_ms '
+                       'or a custom strptime format like %d.%m.%Y %H:%M:%S',
+        'type': 'string',
+        'default': 'iso8601',
+        'displayName': 'Timestamp format',
+        'mandatory': 'false'
+    },
+
+    'streaming': {
+        'description': 'Decode the response incrementally, keeping only the wrapper '
+                       'selected fields and queueing records as they are decoded, '
+                       'to bound memory on large responses',
+        'type': 'boolean',
+        'default': 'false',
+        'displayName': 'Streaming decode',
+        'mandatory': 'false'
+    },
+
+    'chunkSize': {
+        'description': 'Bytes read at a time when streaming',
+        'type': 'integer',
+        'default': '65536',
+        'displayName': 'Streaming chunk size',
+        'mandatory': 'false'
+    },
+
+    'conditionalRequests': {
+        'description': 'Send If-None-Match and If-Modified-Since, '
+                       'skip the poll when the server answers 304',
+        'type': 'boolean',
+        'default': 'false',
+        'displayName': 'Conditional requests',
+        'mandatory': 'false'
+    },
+
+    'changeDetection': {
+        'description': 'Skip the poll when the response body is identical to the last one',
+        'type': 'boolean',
+        'default': 'false',
+        'displayName': 'Change detection',
+        'mandatory': 'false'
+    },
+
+    'queueSize': {
+        'description': 'Maximum number of readings waiting between polling and ingest',
+        'type': 'integer',
+        'default': '10000',
+        'displayName': 'Ingest queue size',
+        'mandatory': 'false'
+    },
+
+    'overflowPolicy': {
+        'description': 'What to do when the ingest queue is full: block polling, '
+                       'drop the oldest or drop the newest readings',
+        'type': 'enumeration',
+        'default': 'block',
+        'options': ['block', 'drop_oldest', 'drop_newest'],
+        'displayName': 'Queue overflow policy',
+        'mandatory': 'false'
+    },
+
+    'ingestBatchSize': {
+        'description': 'Maximum number of queued readings passed to one ingest call',
+        'type': 'integer',
+        'default': '1000',
+        'displayName': 'Ingest batch size',
+        'mandatory': 'false'
+    },
+
+    'poolSize': {
+        'description': 'Maximum number of pooled HTTP connections',
+        'type': 'integer',
+        'default': '10',
+        'displayName': 'Connection pool size',
+        'mandatory': 'false'
+    },
+
+    'keepAlive': {
+        'description': 'Seconds an idle connection is kept open, 0 disables keep-alive',
+        'type': 'integer',
+        'default': '30',
+        'displayName': 'Keep-alive in secs',
+        'mandatory': 'false'
+    },
+
+    'dnsCacheTTL': {
+        'description': 'Seconds resolved host names are cached',
+        'type': 'integer',
+        'default': '300',
+        'displayName': 'DNS cache TTL in secs',
+        'mandatory': 'false'
+    },
+
+    'connectTimeout': {
+        'description': 'Timeout for opening a connection in seconds',
+        'type': 'float',
+        'default': '5',
+        'displayName': 'Connect timeout in secs',
+        'mandatory': 'false'
+    },
+
+    'readTimeout': {
+        'description': 'Timeout for reading the response in seconds',
+        'type': 'float',
+        'default': '10',
+        'displayName': 'Read timeout in secs',
+        'mandatory': 'false'
     }
 }
 
@@ -141,23 +361,26 @@ def plugin_start(handle):
 
 
 def plugin_reconfigure(handle, new_config):
+    """
+    Apply the new config in place on the running plugin loop
 
-    old_plugin = handle['plugin']
-
-    old_callback = old_plugin.callback
-    old_ingest_ref = old_plugin.ingest_ref
+    The thread, loop, queued readings and polls in flight are kept,
+    and so are the session and the schedule of endpoints when compatible.
+    """
 
-    plugin_shutdown(handle)
+    plugin = handle['plugin']
 
-    new_handle = plugin_init(new_config)
+    new_handle = copy.deepcopy(new_config)
+    new_handle['plugin'] = plugin
 
-    new_plugin = new_handle['plugin']
-    new_plugin.callback = old_callback
-    new_plugin.ingest_ref = old_ingest_ref
+    if plugin.loop is not None and plugin.loop.is_running():
+        asyncio.run_coroutine_threadsafe(
+            plugin.reconfigure(new_handle), plugin.loop).result(timeout=_SHUTDOWN_TIMEOUT)
+    else:
+        plugin.configure(new_handle)
+        plugin.endpoints = plugin.parse_endpoints(new_handle)
 
-    
-    plugin_start(new_handle)
-    
+    _LOGGER.info(f'South plugin {PLUGIN_NAME} reconfigured.')
     return new_handle
 
 
@@ -166,8 +389,16 @@ def plugin_shutdown(handle):
     try:
         _LOGGER.info(f'South plugin {PLUGIN_NAME} is shutting down.')
         plugin = handle['plugin']
-        plugin.stop()
-        plugin.loop.stop()
+        # the session belongs to the plugin loop, close it there
+        if plugin.loop.is_running():
+            asyncio.run_coroutine_threadsafe(plugin.close(), plugin.loop).result(
+                timeout=_SHUTDOWN_TIMEOUT)
+            plugin.loop.call_soon_threadsafe(plugin.loop.stop)
+            plugin.thread.join(timeout=_SHUTDOWN_TIMEOUT)
+        else:
+            plugin.loop.run_until_complete(plugin.close())
+        if not plugin.loop.is_running():
+            plugin.loop.close()
     except Exception as e:
         _LOGGER.exception(str(e))
         raise
@@ -190,17 +421,253 @@ def plugin_register_ingest(handle, callback, ingest_ref):
     plugin.ingest_ref = ingest_ref
 
 
+class Endpoint(object):
+    """
+    One source to poll, with its own url, headers, wrapper, asset and interval
+    """
+
+    def __init__(self, **options):
+        # scheduling: wall-clock tick, polls in flight and backoff
+        self.handler = None
+        self.in_flight = 0
+        self.next_tick = 0
+        self.failures = 0
+        self.backoff_until = 0
+        self.retry_after = None
+        self.missed = 0
+        self.late = 0
+        self.backed_off = 0
+        self.skipped = 0
+        self.bad_timestamps = 0
+        self.missing_timestamps = 0
+        self.bad_records = 0
+
+        self.configure(**options)
+
+    def configure(self, url, headers, asset, wrapper, interval,
+                  records='', pagination=None, max_pages=1, max_in_flight=1,
+                  timestamp='', timestamp_format='iso8601'):
+        """
+        Apply the endpoint config, also used to update a polled endpoint
+
+        Everything is built before it is assigned, so a bad config leaves
+        the endpoint as it was.
+        """
+        pagination = pagination or {}
+        records_path = _parse_path(records)
+        next_path = _parse_path(pagination.get('next', ''))
+        cursor_path = _parse_path(pagination.get('cursor', ''))
+        timestamp_path = _parse_path(timestamp)
+        parse_timestamp = _TimestampParser(timestamp_format).parse
+
+        self.url = url
+        self.headers = headers
+        self.asset = asset
+        self.wrapper = wrapper
+        # ticks are multiples of the interval, it cannot be 0
+        self.interval = max(1, interval)
+        self.max_in_flight = max(1, max_in_flight)
+
+        # batch mode: where the array is and how to get the next page
+        self.records_path = records_path
+        self.next_path = next_path
+        self.cursor_path = cursor_path
+        self.cursor_param = pagination.get('param', 'cursor')
+        self.max_pages = max(1, max_pages)
+
+        self.get_records = _compile_path(self.records_path)
+        self.get_next = _compile_path(self.next_path, default=None)
+        self.get_cursor = _compile_path(self.cursor_path, default=None)
+
+        # source timestamp, None stamps readings with the time of the poll
+        self.timestamp_path = timestamp_path
+        self.get_timestamp = None
+        if self.timestamp_path:
+            self.get_timestamp = _compile_path(self.timestamp_path, default=None)
+            self.parse_timestamp = parse_timestamp
+
+        # ETag, Last-Modified and body digest of the last ingested response,
+        # forgotten on reconfigure as the same body may now map differently
+        self.validators = _NO_VALIDATORS
+
+        # parse wrapper and compile the locations once,
+        # so every poll only walks the precompiled steps
+        parsed_wrapper = {}
+        try:
+            for reading_name, json_location in self.wrapper.items():
+                try:
+                    parsed_wrapper[reading_name] = _parse_path(str(json_location))
+                except ValueError as exc:
+                    _LOGGER.error(f'Skipping {reading_name} in wrapper: {exc}')
+        # need to catch some json errors...
+        except Exception:
+            pass
+        self.parsed_wrapper = parsed_wrapper
+        self.accessors = [(reading_name, _compile_path(steps))
+                          for reading_name, steps in parsed_wrapper.items()]
+
+        self.stream_spec = self.build_stream_spec()
+
+    def build_stream_spec(self):
+        """
+        Describe which parts of a response are kept when streaming
+
+        The spec is a nested dict of keys: None keeps the whole value,
+        a dict descends into an object and _ITEMS walks an array element
+        by element. Everything else in the response is skipped unparsed.
+        Locations with indexes or wildcards keep the value where the plain
+        keys end, the compiled accessors pick from it afterwards.
+        """
+        element = {}
+        for steps in self.parsed_wrapper.values():
+            element = _merge_spec(element, steps, None)
+        if self.timestamp_path:
+            element = _merge_spec(element, self.timestamp_path, None)
+
+        if not self.records_path:
+            # one object, or every element if the response is an array
+            spec = dict(element) if element is not None else None
+            if spec is not None:
+                spec[_ITEMS] = element
+        else:
+            spec = _merge_spec({}, self.records_path, {_ITEMS: element})
+
+        for path in (self.next_path, self.cursor_path):
+            if path:
+                spec = _merge_spec(spec, path, None)
+
+        return spec
+
+    def succeeded(self):
+        """Poll went through, stop backing off"""
+        self.failures = 0
+        self.backoff_until = 0
+
+    def failed(self, max_backoff):
+        """
+        Poll failed or was throttled, back off before the next one
+
+        Retry-After from the server is honored, otherwise the delay doubles
+        with every failure in a row up to max_backoff, with jitter so that
+        endpoints failing together do not retry together.
+
+        Returns:
+            delay: seconds until the endpoint is polled again
+        """
+        self.failures += 1
+        if self.retry_after is not None:
+            delay = self.retry_after
+            self.retry_after = None
+        else:
+            delay = min(max_backoff, self.interval * 2 ** min(self.failures - 1, 16))
+            delay = delay / 2 + random.uniform(0, delay / 2)
+        self.backoff_until = time.time() + delay
+        return delay
+
+    def is_batch(self, raw_data):
+        """Is the response read as an array of measurements"""
+        return bool(self.records_path) or isinstance(raw_data, list)
+
+    def format_data(self, raw_data):
+        """
+        Pass the values forward...
+        
+        Args:
+            raw_data:
+        Returns:
+            data: a dict with:
+                asset: The asset key of the sensor device that is being read
+                timestamp: A timestamp for the reading data
+                readings: The reading data itself as a JSON object
+                or in batch mode a list of those dicts, one per array element
+
+        """
+        # note: without a timestamp location this timestamp is now,
+        # not when the reading itself was recorded
+        time_stamp = str(datetime.now(tz=timezone.utc))
+
+        if not self.is_batch(raw_data):
+            return self.format_reading(raw_data, time_stamp)
+
+        return self.format_records(self.get_records(raw_data), time_stamp)
+
+    def format_records(self, records, time_stamp):
+        """
+        Map the records of a batch, skipping the ones missing a wrapper field
+
+        One bad record does not fail the page, it is logged and counted.
+        """
+        data = []
+        for record in records:
+            try:
+                data.append(self.format_reading(record, time_stamp))
+            except KeyError as exc:
+                self.bad_records += 1
+                _LOGGER.warning(f'Record without {exc} from {self.url} skipped, '
+                                f'total: {self.bad_records}')
+        return data
+
+    def format_reading(self, record, time_stamp):
+        """Map one object through the compiled wrapper"""
+        readings = {}
+        for key, get in self.accessors:
+            readings[key] = get(record)
+
+        if self.get_timestamp is not None:
+            value = self.get_timestamp(record)
+            if value is None:
+                # records without a timestamp are expected, they are only counted
+                self.missing_timestamps += 1
+            else:
+                try:
+                    time_stamp = self.parse_timestamp(value)
+                except (ValueError, TypeError, OverflowError, OSError) as exc:
+                    # one bad record does not fail the poll, it keeps the poll time
+                    self.bad_timestamps += 1
+                    _LOGGER.warning(f'Bad timestamp {value!r} from {self.url}: {exc}, '
+                                    f'using the poll time, total: {self.bad_timestamps}')
+
+        data = {
+            'asset': self.asset,
+            'timestamp': time_stamp,
+            'readings': readings
+        }
+
+        return data
+
+    def next_page(self, raw_data, url):
+        """
+        Url of the page after raw_data, None when there are no more pages
+
+        Args:
+            raw_data: decoded page
+            url: url the page was read from
+        """
+        if self.next_path:
+            link = self.get_next(raw_data)
+            return urljoin(url, link) if link else None
+
+        if self.cursor_path:
+            cursor = self.get_cursor(raw_data)
+            if cursor is None or cursor == '':
+                return None
+            parts = urlsplit(self.url)
+            query = [(key, value) for key, value in parse_qsl(parts.query)
+                     if key != self.cursor_param]
+            query.append((self.cursor_param, str(cursor)))
+            return urlunsplit(parts._replace(query=urlencode(query)))
+
+        return None
+
+
 class SouthPlugin(object):
     """ 
     Actual code to communicate with source
-    Using threading and loop
+    Using threading and loop, all endpoints share the same loop and session
     """
 
     def __init__(self, handle):
-        self.url = handle['url']['value']
-        self.headers = handle['headers']['value']
-        self.asset = handle['assetName']['value']
-        self.wrapper = handle['wrapper']['value']
+        self.endpoints = self.parse_endpoints(handle)
         
         self.ingest_ref = None
         self.callback = None
@@ -208,106 +675,1047 @@ class SouthPlugin(object):
         self.loop = None
         self.thread  = None
 
-        self._interval = int(handle['interval']['value'])
-        self._handler = None
+        # polls in flight, cancelled on shutdown
+        self._tasks = set()
 
-        # parse wrapper
-        wrapper =  {}
-        try:
-            for reading_name, json_location in self.wrapper.items():
-                wrapper[reading_name] = json_location
-        # need to catch some json errors...
-        except Exception:
-            pass
-        self.parsed_wrapper = wrapper
+        # bounds the requests in flight over all endpoints,
+        # created lazily so that it belongs to the plugin loop
+        self._semaphore = None
+        self.skipped_polls = 0
+
+        # bounded queue between polling and ingest, drained by one worker
+        # that coalesces queued readings into one callback,
+        # created lazily so that it belongs to the plugin loop
+        self._queue = None
+        self._worker = None
+        self.dropped_readings = 0
+
+        # one pooled session per plugin, created lazily on the plugin loop
+        self.session = None
+        # sessions replaced on reconfigure that are not closed yet
+        self._old_sessions = []
+
+        self.configure(handle)
+
+    def configure(self, handle):
+        """Apply the plugin level config, the endpoints are built separately"""
+        self._max_concurrent = int(handle['maxConcurrent']['value'])
+
+        # skip polls whose data has not changed since the last ingest
+        self._conditional = handle['conditionalRequests']['value'] == 'true'
+        self._change_detection = handle['changeDetection']['value'] == 'true'
+
+        self._max_backoff = int(handle['maxBackoff']['value'])
+        self._late_tolerance = float(handle['lateTolerance']['value'])
+
+        self._queue_size = max(1, int(handle['queueSize']['value']))
+        self._overflow_policy = handle['overflowPolicy']['value']
+        self._ingest_batch_size = max(1, int(handle['ingestBatchSize']['value']))
+
+        # decode responses incrementally instead of loading the whole body
+        self._streaming = handle['streaming']['value'] == 'true'
+        self._chunk_size = int(handle['chunkSize']['value'])
+
+        self._pool_size = int(handle['poolSize']['value'])
+        self._keep_alive = int(handle['keepAlive']['value'])
+        self._dns_cache_ttl = int(handle['dnsCacheTTL']['value'])
+        self._connect_timeout = float(handle['connectTimeout']['value'])
+        self._read_timeout = float(handle['readTimeout']['value'])
+
+    def _session_options(self):
+        return (self._pool_size, self._keep_alive, self._dns_cache_ttl,
+                self._connect_timeout, self._read_timeout)
+
+    async def reconfigure(self, handle):
+        """
+        Swap to the new config on the plugin loop
 
-    def _run(self):
-        """ Run looper every (interval) seconds"""
-        self.looper()
-        self._handler = self.loop.call_later(self._interval, self._run)
+        Nothing is awaited while swapping, so polls never see half of
+        the new config. Endpoints are matched by url: a matched endpoint
+        is updated in place and keeps its pending tick if its interval did
+        not change. The session is replaced only if its options changed,
+        the old one is closed once polls using it had time to finish.
+        """
+        session_options = self._session_options()
+        max_concurrent = self._max_concurrent
+        queue_size = self._queue_size
+
+        # build everything first, a bad config raises before anything changes
+        options = self.endpoint_options(handle)
+        fresh = [Endpoint(**option) for option in options]
+        self.configure(handle)
+
+        current = {}
+        for endpoint in self.endpoints:
+            current.setdefault(endpoint.url, []).append(endpoint)
+
+        endpoints = []
+        for option, endpoint in zip(options, fresh):
+            matches = current.get(option['url'])
+            if matches:
+                interval = matches[0].interval
+                endpoint = matches.pop(0)
+                endpoint.configure(**option)
+                if endpoint.interval != interval:
+                    if endpoint.handler:
+                        endpoint.handler.cancel()
+                    endpoint.next_tick = 0
+                    self._schedule(endpoint)
+            else:
+                self._schedule(endpoint)
+            endpoints.append(endpoint)
+
+        for removed in current.values():
+            for endpoint in removed:
+                if endpoint.handler:
+                    endpoint.handler.cancel()
+
+        self.endpoints = endpoints
+
+        if self._max_concurrent != max_concurrent:
+            # polls in flight release the old one
+            self._semaphore = None
+
+        if self._queue_size != queue_size and self._queue is not None:
+            self._resize_queue()
+
+        if self._session_options() != session_options and self.session is not None:
+            self._old_sessions.append(self.session)
+            self.loop.call_later(self._connect_timeout + self._read_timeout,
+                                 self._close_old_session, self.session)
+            self.session = None
+
+    def _close_old_session(self, session):
+        """Close a replaced session after the polls using it have timed out"""
+        if session in self._old_sessions:
+            self._old_sessions.remove(session)
+            self.loop.create_task(session.close())
+
+    def _resize_queue(self):
+        """Change the size of the queue in place, polls waiting on it keep it"""
+        self._queue.resize(self._queue_size)
+        if self._overflow_policy == 'drop_oldest':
+            while self._queue.qsize() > self._queue_size:
+                self._queue.get_nowait()
+                self.dropped_readings += 1
+
+    @classmethod
+    def parse_endpoints(cls, handle):
+        """Build the endpoints from config"""
+        return [Endpoint(**options) for options in cls.endpoint_options(handle)]
+
+    @staticmethod
+    def endpoint_options(handle):
+        """
+        Options of every endpoint in config
+
+        Every item in the endpoints list can override url, headers, wrapper,
+        assetName, interval, maxInFlight, records, pagination, maxPages,
+        timestamp and timestampFormat, the rest come from the top level config.
+        Without a list the top level config is the only endpoint.
+        """
+        defaults = {
+            'url': handle['url']['value'],
+            'headers': handle['headers']['value'],
+            'assetName': handle['assetName']['value'],
+            'wrapper': handle['wrapper']['value'],
+            'interval': handle['interval']['value'],
+            'records': handle['records']['value'],
+            'pagination': handle['pagination']['value'],
+            'maxPages': handle['maxPages']['value'],
+            'maxInFlight': handle['maxInFlight']['value'],
+            'timestamp': handle['timestamp']['value'],
+            'timestampFormat': handle['timestampFormat']['value']
+        }
+
+        items = handle['endpoints']['value'] or [{}]
+
+        endpoints = []
+        for item in items:
+            options = dict(defaults, **item)
+            endpoints.append(dict(
+                url=options['url'],
+                headers=options['headers'],
+                asset=options['assetName'],
+                wrapper=options['wrapper'],
+                interval=int(options['interval']),
+                records=options['records'],
+                pagination=options['pagination'],
+                max_pages=int(options['maxPages']),
+                max_in_flight=int(options['maxInFlight']),
+                timestamp=options['timestamp'],
+                timestamp_format=options['timestampFormat']
+            ))
+
+        return endpoints
+
+    def _schedule(self, endpoint):
+        """
+        Schedule the next poll on the next wall-clock tick
+
+        Ticks are multiples of the interval since the epoch, so polls
+        do not drift however long each poll or callback takes.
+        """
+        now = time.time()
+        last = max(now, endpoint.next_tick)
+        endpoint.next_tick = (math.floor(last / endpoint.interval) + 1) * endpoint.interval
+        endpoint.handler = self.loop.call_at(
+            self.loop.time() + endpoint.next_tick - now, self._run, endpoint)
+
+    def _run(self, endpoint):
+        """ Run looper on every tick, unless backing off or at the in-flight limit"""
+        now = time.time()
+        lateness = now - endpoint.next_tick
+        self._schedule(endpoint)
+
+        missed = int(lateness // endpoint.interval)
+        if missed > 0:
+            endpoint.missed += missed
+            _LOGGER.warning(f'Missed {missed} ticks of {endpoint.url}, '
+                            f'total missed: {endpoint.missed}')
+        elif lateness > self._late_tolerance:
+            endpoint.late += 1
+            _LOGGER.info(f'Tick of {endpoint.url} late by {lateness:.3f} secs, '
+                         f'total late: {endpoint.late}')
+
+        if now < endpoint.backoff_until:
+            endpoint.backed_off += 1
+            _LOGGER.debug(f'Backing off {endpoint.url} for '
+                          f'{endpoint.backoff_until - now:.1f} secs')
+            return
+
+        if endpoint.in_flight >= endpoint.max_in_flight:
+            endpoint.missed += 1
+            _LOGGER.warning(f'Missed tick of {endpoint.url}, {endpoint.in_flight} '
+                            f'polls still in flight, total missed: {endpoint.missed}')
+            return
+
+        self.looper(endpoint)
 
     def start(self):
-        self._handler = self.loop.call_later(self._interval, self._run)
+        self._worker = self.loop.create_task(self._ingest_worker())
+        for endpoint in self.endpoints:
+            self._schedule(endpoint)
 
     def stop(self):
-        self._handler.cancel()
+        for endpoint in self.endpoints:
+            if endpoint.handler:
+                endpoint.handler.cancel()
+
+    async def close(self):
+        """Stop polling and close the pooled session, run on the plugin loop"""
+        self.stop()
+        for endpoint in self.endpoints:
+            _LOGGER.info(f'{endpoint.url}: missed ticks {endpoint.missed}, '
+                         f'late ticks {endpoint.late}, backed off ticks '
+                         f'{endpoint.backed_off}, skipped polls {endpoint.skipped}, '
+                         f'bad timestamps {endpoint.bad_timestamps}, '
+                         f'missing timestamps {endpoint.missing_timestamps}, '
+                         f'bad records {endpoint.bad_records}')
+
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        # pass on what is still queued
+        while self.queue_depth:
+            self._ingest_batch(self._take_batch([]))
+        _LOGGER.info(f'Dropped readings: {self.dropped_readings}')
+        for session in self._old_sessions:
+            await session.close()
+        self._old_sessions = []
+
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _get_queue(self):
+        if self._queue is None:
+            self._queue = _ReadingQueue(maxsize=self._queue_size)
+        return self._queue
+
+    @property
+    def queue_depth(self):
+        """Number of readings waiting to be ingested"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def enqueue(self, data):
+        """
+        Queue readings for the ingest worker
+
+        When the queue is full the overflow policy decides: block waits for
+        room and so holds back polling, drop_oldest discards the longest
+        waiting readings and drop_newest discards the new ones.
+
+        Args:
+            data: a reading dict or a list of them
+        """
+        queue = self._get_queue()
+        readings = data if isinstance(data, list) else [data]
+
+        if self._overflow_policy == 'drop_newest':
+            for reading in readings:
+                try:
+                    queue.put_nowait(reading)
+                except asyncio.QueueFull:
+                    self.dropped_readings += 1
+        elif self._overflow_policy == 'drop_oldest':
+            for reading in readings:
+                if queue.full():
+                    queue.get_nowait()
+                    self.dropped_readings += 1
+                queue.put_nowait(reading)
+        else:
+            for reading in readings:
+                await queue.put(reading)
+
+        _LOGGER.debug(f'Queue depth {self.queue_depth}, '
+                      f'dropped readings {self.dropped_readings}')
+
+    def _take_batch(self, batch):
+        """Add queued readings to batch without waiting, up to the batch size"""
+        while len(batch) < self._ingest_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    def _ingest_batch(self, batch):
+        try:
+            async_ingest.ingest_callback(self.callback, self.ingest_ref, batch)
+        except Exception as exc:
+            _LOGGER.error(f'Ingest error: {exc}, lost {len(batch)} readings')
+
+    async def _ingest_worker(self):
+        """Pass queued readings to ingest, coalescing them into one callback"""
+        queue = self._get_queue()
+        while True:
+            batch = self._take_batch([await queue.get()])
+            _LOGGER.debug(f'Ingesting {len(batch)} readings, queue depth {queue.qsize()}')
+            self._ingest_batch(batch)
 
-    def looper(self):
+    def _create_session(self):
+        """
+        Create the long-lived session used for every poll
+
+        Connections are pooled and kept alive between polls so that
+        a new TCP connection and TLS handshake is not needed every interval.
+        """
+        if self._keep_alive > 0:
+            connector = aiohttp.TCPConnector(
+                limit=self._pool_size,
+                keepalive_timeout=self._keep_alive,
+                use_dns_cache=True,
+                ttl_dns_cache=self._dns_cache_ttl)
+        else:
+            connector = aiohttp.TCPConnector(
+                limit=self._pool_size,
+                force_close=True,
+                use_dns_cache=True,
+                ttl_dns_cache=self._dns_cache_ttl)
+
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=self._connect_timeout,
+            sock_read=self._read_timeout)
+
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    def looper(self, endpoint):
         """
         Actual code to run in loops
         """
-        self.loop.create_task(self.fetch())
+        endpoint.in_flight += 1
+        task = self.loop.create_task(self.fetch(endpoint))
+        self._tasks.add(task)
+        task.add_done_callback(lambda done: self._finished(endpoint, done))
 
-    async def fetch(self):
-        _LOGGER.debug("Plugin polling...")
+    def _finished(self, endpoint, task):
+        endpoint.in_flight -= 1
+        self._tasks.discard(task)
+
+    async def fetch(self, endpoint):
+        _LOGGER.debug(f'Plugin polling {endpoint.url}...')
         data = None
         raw_data = None
         status = None
 
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrent)
+
         try:
-            raw_data, status = await self.get_data()
-            if (status == 200):
-                data = self.format_data(raw_data)
-                _LOGGER.debug('Got data...')
-            else:
-                _LOGGER.info(f'Wrong status: {status}')
+            async with self._semaphore:
+                raw_data, status, validators, unchanged = await self.get_data(endpoint)
+                if unchanged:
+                    # not modified or same body as last time, nothing to ingest
+                    endpoint.skipped += 1
+                    self.skipped_polls += 1
+                    _LOGGER.debug(f'Unchanged data from {endpoint.url}, '
+                                  f'skipped polls: {self.skipped_polls}')
+                    endpoint.succeeded()
+                    return
+                if (status == 200):
+                    endpoint.succeeded()
+                    if raw_data is not None:
+                        data = endpoint.format_data(raw_data)
+                    _LOGGER.debug('Got data...')
+                else:
+                    _LOGGER.info(f'Wrong status: {status} from {endpoint.url}')
+                    self.check_throttled(endpoint, status)
+                    return
+
+                # a null body has no readings
+                if raw_data is not None and endpoint.is_batch(raw_data):
+                    # every page is queued once read, not gathered into one list
+                    await self.enqueue(data)
+                    data = None
+                    await self.fetch_pages(endpoint, raw_data)
 
         except KeyError as exc:
             _LOGGER.error(f'Key mismatch: {exc}')
         except Exception as exc:
-            _LOGGER.error(f'Data fetching error: {exc}')
+            delay = endpoint.failed(self._max_backoff)
+            _LOGGER.error(f'Data fetching error: {exc}, '
+                          f'backing off {endpoint.url} for {delay:.1f} secs')
 
         else:
-            _LOGGER.debug("Returning data...")
-            async_ingest.ingest_callback(self.callback, self.ingest_ref, data)
+            if data:
+                _LOGGER.debug("Returning data...")
+                await self.enqueue(data)
+            # remember the validators only once the data has been queued
+            endpoint.validators = validators
         
-    async def get_data(self):
+    async def fetch_pages(self, endpoint, raw_data):
         """
-        Request the data from url using headers
+        Follow the pagination of a batch response
+
+        The readings of every page are queued before the next page is
+        requested, so only one page is held at a time.
 
         Args:
+            endpoint: the endpoint polled
+            raw_data: the decoded first page
+        """
+        url = endpoint.url
+        pages = 1
+        while pages < endpoint.max_pages:
+            url = endpoint.next_page(raw_data, url)
+            if not url:
+                return
+
+            raw_data, status, _, _ = await self.get_data(endpoint, url)
+            if status != 200:
+                _LOGGER.info(f'Wrong status: {status} from {url}, '
+                             f'stopping after {pages} pages')
+                self.check_throttled(endpoint, status)
+                return
+            if raw_data is None:
+                _LOGGER.debug(f'Empty page {url}, stopping after {pages} pages')
+                return
+
+            await self.enqueue(endpoint.format_data(raw_data))
+            pages += 1
+
+        _LOGGER.debug(f'Read maximum of {pages} pages from {endpoint.url}')
+
+    def check_throttled(self, endpoint, status):
+        """Back off the endpoint when the status asks to retry later"""
+        if status in _RETRY_STATUSES or status >= 500:
+            delay = endpoint.failed(self._max_backoff)
+            _LOGGER.warning(f'Status {status} from {endpoint.url}, '
+                            f'backing off for {delay:.1f} secs')
+
+    async def get_data(self, endpoint, url=None):
+        """
+        Request the data from endpoint url using its headers
+
+        With conditional requests the ETag and Last-Modified of the last
+        ingested response are sent back, so the server can answer 304.
+        With change detection a body identical to the last ingested one
+        is not decoded and resp is None. Both apply only to the first page.
+        When streaming only the parts in the endpoint stream spec are decoded
+        and the records are queued in slices as they are decoded, resp keeps
+        an empty records array. The first page with change detection is the
+        exception, its records are kept until the digest of the whole body
+        shows whether it changed.
+
+        Args:
+            endpoint: the endpoint to poll
+            url: url of a following page, None for the first page
 
         Return:
-            resp: response json formatted
+            resp: response json formatted, None without a body to decode
             status: status code
+            validators: ETag, Last-Modified and body digest of the response
+            unchanged: True for a 304 or a body identical to the last one
         """
 
+        if self.session is None or self.session.closed:
+            self.session = self._create_session()
+
+        headers = endpoint.headers
+        last = endpoint.validators
+        if url is not None:
+            last = _NO_VALIDATORS
+        elif self._conditional and (last['etag'] or last['last_modified']):
+            headers = dict(headers or {})
+            if last['etag']:
+                headers['If-None-Match'] = last['etag']
+            if last['last_modified']:
+                headers['If-Modified-Since'] = last['last_modified']
+
+        resp = None
+        validators = last
+        unchanged = False
+
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.url, headers=self.headers) as response:
-                    status = response.status
-                    resp = await response.json()
-            
+            async with self.session.get(url or endpoint.url, headers=headers) as response:
+                status = response.status
+                unchanged = status == 304
+                if status in _RETRY_STATUSES:
+                    endpoint.retry_after = _parse_retry_after(
+                        response.headers.get('Retry-After'))
+                if status == 200:
+                    hasher = None
+                    if self._change_detection and url is None:
+                        hasher = hashlib.blake2b(digest_size=16)
+
+                    if self._streaming:
+                        chunks = _read_chunks(response, self._chunk_size, hasher)
+                        on_records = None
+                        if hasher is None:
+                            on_records = self._queue_records(endpoint)
+                        stream = _JsonStream(chunks, on_records, self._ingest_batch_size)
+                        resp = await stream.select(endpoint.stream_spec)
+                    else:
+                        body = await response.read()
+                        if hasher is not None:
+                            hasher.update(body)
+
+                    digest = hasher.digest() if hasher is not None else None
+
+                    validators = {
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                        'digest': digest
+                    }
+
+                    if digest is not None and digest == last['digest']:
+                        unchanged = True
+                        resp = None
+                    elif not self._streaming:
+                        resp = json.loads(body)
+
         except (Exception, RuntimeError) as err:
             _LOGGER.error(f'Error with session: {err}')
             raise err
 
-        return resp, status
+        return resp, status, validators, unchanged
 
-    def format_data(self, raw_data):
+    def _queue_records(self, endpoint):
+        """Coroutine function queueing slices of streamed records of endpoint"""
+        # like format_data the records of one response share the poll time
+        time_stamp = str(datetime.now(tz=timezone.utc))
+
+        async def queue_records(records):
+            await self.enqueue(endpoint.format_records(records, time_stamp))
+
+        return queue_records
+
+
+class _ReadingQueue(asyncio.Queue):
+    """
+    Queue of readings whose size can change while polls wait on it
+
+    When the queue shrinks the readings above the new size stay queued,
+    puts block until the worker has taken them.
+    """
+
+    def resize(self, maxsize):
+        self._maxsize = maxsize
+        # waiting puts check again whether there is room
+        while self._putters:
+            self._wakeup_next(self._putters)
+
+
+_PATH_STEP = re.compile(
+    r"""\.?(?:\[(?:(\d+)|(\*)|'([^']*)'|"([^"]*)")\]|([^.\[\]]+))""")
+
+
+def _parse_path(location):
+    """
+    Parse a location into steps
+
+    Locations are dotted keys with optional JSONPath style parts:
+    "data.items[0].value", "$.data.items[*].value", "data['key.with.dots']".
+    Numbers in brackets select list indexes and * selects every element,
+    a dotted number like "sensors.1" is a key as before. An empty
+    location gives no steps, which selects the whole document.
+
+    Returns:
+        steps: list of str keys, int indexes and _WILDCARD
+    """
+    if location.startswith('$'):
+        location = location[1:]
+
+    steps = []
+    pos = 0
+    while pos < len(location):
+        match = _PATH_STEP.match(location, pos)
+        if not match or match.end() == pos:
+            raise ValueError(f'Invalid location {location!r} at {pos}')
+        index, wildcard, single, double, key = match.groups()
+        if index is not None:
+            steps.append(int(index))
+        elif wildcard or key == '*':
+            steps.append(_WILDCARD)
+        elif key is not None:
+            steps.append(key)
+        else:
+            steps.append(single if single is not None else double)
+        pos = match.end()
+
+    return steps
+
+
+def _compile_path(steps, default=_MISSING):
+    """
+    Compile parsed steps into an accessor function
+
+    The accessor walks the precompiled steps directly. A wildcard returns a
+    list of the values found under every element, skipping elements where
+    the rest of the location is missing. Without default a missing location
+    raises KeyError.
+    """
+    location = _format_path(steps)
+
+    if _WILDCARD in steps:
+        wildcard = steps.index(_WILDCARD)
+        get_head = _compile_path(steps[:wildcard])
+        rest = steps[wildcard + 1:]
+        get_rest = _compile_path(rest)
+        flatten = _WILDCARD in rest
+
+        def get_all(data):
+            try:
+                items = get_head(data)
+            except KeyError:
+                if default is _MISSING:
+                    raise KeyError(location) from None
+                return default
+            if isinstance(items, dict):
+                items = items.values()
+            elif not isinstance(items, list):
+                if default is _MISSING:
+                    raise KeyError(location)
+                return default
+
+            values = []
+            for item in items:
+                try:
+                    value = get_rest(item)
+                except KeyError:
+                    continue
+                if flatten:
+                    values.extend(value)
+                else:
+                    values.append(value)
+            return values
+
+        return get_all
+
+    keys = tuple(steps)
+
+    if len(keys) == 1:
+        key = keys[0]
+
+        def get_one(data):
+            try:
+                return data[key]
+            except (KeyError, IndexError, TypeError):
+                if default is _MISSING:
+                    raise KeyError(location) from None
+                return default
+
+        return get_one
+
+    def get(data):
+        try:
+            for key in keys:
+                data = data[key]
+        except (KeyError, IndexError, TypeError):
+            if default is _MISSING:
+                raise KeyError(location) from None
+            return default
+        return data
+
+    return get
+
+
+def _format_path(steps):
+    """Location of the steps as text, for error messages"""
+    text = ''
+    for step in steps:
+        if step is _WILDCARD:
+            text += '[*]'
+        elif isinstance(step, int):
+            text += f'[{step}]'
+        else:
+            text += f'.{step}' if text else step
+    return text
+
+
+class _TimestampParser(object):
+    """
+    Convert source timestamps to Fledge timestamps, fast for large batches
+
+    The format is decided once. ISO-8601 values are matched with one regex
+    and the epoch of their date, hour and minute is cached, so consecutive
+    timestamps only add seconds and fraction. The text of every whole second
+    is cached too, as batches carry many timestamps within the same second.
+    Custom formats fall back to strptime with the results memoized.
+    """
+
+    _ISO8601 = re.compile(
+        r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d+))?)?'
+        r'\s*(Z|z|[+-]\d{2}(?::?\d{2})?)?$')
+
+    # entries kept in each cache before it is cleared
+    _CACHE_SIZE = 4096
+
+    def __init__(self, timestamp_format):
+        self._minutes = {}
+        self._offsets = {}
+        self._seconds = {}
+        self._parsed = {}
+
+        self._format = timestamp_format
+        if timestamp_format == 'iso8601':
+            self.to_epoch = self._iso8601
+        elif timestamp_format == 'epoch_s':
+            self.to_epoch = float
+        elif timestamp_format == 'epoch_ms':
+            self.to_epoch = self._epoch_ms
+        else:
+            self.to_epoch = self._custom
+
+    def parse(self, value):
         """
-        Pass the values forward...
-        
         Args:
-            raw_data:
+            value: the timestamp read from the record
         Returns:
-            data: a dict with:
-                asset: The asset key of the sensor device that is being read
-                timestamp: A timestamp for the reading data
-                readings: The reading data itself as a JSON object
-
+            timestamp: UTC timestamp as text like 2024-01-01 12:00:00.000000+00:00
         """
-        readings = {}
-        for key, value in self.parsed_wrapper.items():
-            readings[key] = raw_data[value]
+        return self.format(self.to_epoch(value))
+
+    def format(self, epoch):
+        second = math.floor(epoch)
+        micros = round((epoch - second) * 1000000)
+        if micros == 1000000:
+            second += 1
+            micros = 0
+
+        prefix = self._seconds.get(second)
+        if prefix is None:
+            if len(self._seconds) >= self._CACHE_SIZE:
+                self._seconds.clear()
+            prefix = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(second))
+            self._seconds[second] = prefix
+
+        return f'{prefix}.{micros:06d}+00:00'
+
+    @staticmethod
+    def _epoch_ms(value):
+        return float(value) / 1000
+
+    def _iso8601(self, value):
+        match = self._ISO8601.match(value)
+        if not match:
+            raise ValueError(f'Timestamp {value!r} is not ISO-8601')
+        year, month, day, hour, minute, second, fraction, offset = match.groups()
+
+        key = value[:match.end(5)]
+        base = self._minutes.get(key)
+        if base is None:
+            if len(self._minutes) >= self._CACHE_SIZE:
+                self._minutes.clear()
+            # datetime rejects days past the end of the month, timegm rolls over
+            base = calendar.timegm(datetime(int(year), int(month), int(day),
+                                            int(hour), int(minute)).timetuple())
+            self._minutes[key] = base
+
+        epoch = base
+        if second:
+            if int(second) > 59:
+                raise ValueError(f'Timestamp {value!r} second is out of range')
+            epoch += int(second)
+        if fraction:
+            epoch += int(fraction) / 10 ** len(fraction)
+        if offset and offset not in 'Zz':
+            epoch -= self._offset(offset)
+        return epoch
+
+    def _offset(self, offset):
+        seconds = self._offsets.get(offset)
+        if seconds is None:
+            digits = offset[1:].replace(':', '')
+            seconds = int(digits[:2]) * 3600 + int(digits[2:] or 0) * 60
+            if offset[0] == '-':
+                seconds = -seconds
+            self._offsets[offset] = seconds
+        return seconds
+
+    def _custom(self, value):
+        epoch = self._parsed.get(value)
+        if epoch is None:
+            if len(self._parsed) >= self._CACHE_SIZE:
+                self._parsed.clear()
+            parsed = datetime.strptime(value, self._format)
+            if parsed.tzinfo is None:
+                parsed = parsed.replace(tzinfo=timezone.utc)
+            epoch = parsed.timestamp()
+            self._parsed[value] = epoch
+        return epoch
+
+
+def _parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, in seconds or as HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
 
-        # note: this timestamp is now, not when the reading itself was recorded
-        time_stamp = str(datetime.now(tz=timezone.utc))
 
-        data = {
-            'asset': self.asset,
-            'timestamp': time_stamp,
-            'readings': readings
-        }
+def _merge_spec(spec, steps, leaf):
+    """
+    Add a location to a streaming spec, ending with leaf
 
-        return data
+    Only the plain keys at the start of the location are streamed,
+    the value where they end is kept whole.
+
+    Returns:
+        spec: the merged spec, None when the whole document is kept
+    """
+    keys = []
+    for step in steps:
+        if not isinstance(step, str):
+            leaf = None
+            break
+        keys.append(step)
+
+    if spec is None or not keys:
+        return None
+
+    root = spec
+    for key in keys[:-1]:
+        child = spec.get(key, {})
+        if child is None:
+            # the whole value is already kept
+            return root
+        spec[key] = child
+        spec = child
+    if keys[-1] not in spec or leaf is None:
+        spec[keys[-1]] = leaf
+    return root
+
+
+async def _read_chunks(response, chunk_size, hasher=None):
+    """Read the response body in chunks, feeding the hasher on the way"""
+    async for chunk in response.content.iter_chunked(chunk_size):
+        if hasher is not None:
+            hasher.update(chunk)
+        yield chunk
+
+
+class _JsonStream(object):
+    """
+    Incremental JSON decoder that keeps only the selected parts of a document
+
+    Text is read from an async iterator of byte chunks. Values that are not
+    selected are skipped by scanning for their end without building objects,
+    and consumed text is dropped, so memory is bounded by the chunk size and
+    the size of the selected values instead of the size of the document.
+    With on_records the elements of the records array are not kept either,
+    they are passed on in slices of slice_size as soon as they are decoded.
+    """
+
+    _WHITESPACE = re.compile(r'[ \t\n\r]*')
+    _STRING_END = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+    _SCALAR_END = re.compile(r'[^ \t\n\r,\]}]*')
+    _STRUCTURE = re.compile(r'[\[\]{}"]')
+
+    def __init__(self, chunks, on_records=None, slice_size=1):
+        self._chunks = chunks.__aiter__()
+        self._on_records = on_records
+        self._slice_size = slice_size
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        # start of a value being kept, text after it is not dropped
+        self._mark = None
+        self._eof = False
+
+    async def _fill(self):
+        """Read the next chunk, return False at the end of the stream"""
+        if self._eof:
+            return False
+        try:
+            chunk = await self._chunks.__anext__()
+            text = self._decoder.decode(chunk)
+        except StopAsyncIteration:
+            self._eof = True
+            text = self._decoder.decode(b'', final=True)
+
+        keep = self._pos if self._mark is None else self._mark
+        self._buffer = self._buffer[keep:] + text
+        self._pos -= keep
+        if self._mark is not None:
+            self._mark = 0
+        return True
+
+    async def _need(self):
+        """Read more text, fail if the document ends too early"""
+        if not await self._fill():
+            raise ValueError('Unexpected end of JSON document')
+
+    async def _peek(self):
+        """Skip whitespace and return the next character"""
+        while True:
+            self._pos = self._WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            await self._need()
+
+    async def _skip_string(self):
+        """Move past the string starting at the current position"""
+        while True:
+            match = self._STRING_END.match(self._buffer, self._pos + 1)
+            if match:
+                self._pos = match.end()
+                return
+            await self._need()
+
+    async def _skip_value(self):
+        """Move past the value starting at the current position"""
+        char = await self._peek()
+
+        if char == '"':
+            await self._skip_string()
+            return
+
+        if char not in '{[':
+            while True:
+                end = self._SCALAR_END.match(self._buffer, self._pos).end()
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return
+                await self._fill()
+
+        depth = 0
+        while True:
+            match = self._STRUCTURE.search(self._buffer, self._pos)
+            if not match:
+                self._pos = len(self._buffer)
+                await self._need()
+                continue
+
+            self._pos = match.start()
+            char = match.group()
+            if char == '"':
+                await self._skip_string()
+                continue
+
+            self._pos += 1
+            depth += 1 if char in '{[' else -1
+            if depth == 0:
+                return
+
+    async def _keep_value(self):
+        """Decode the value starting at the current position"""
+        await self._peek()
+        self._mark = self._pos
+        try:
+            await self._skip_value()
+            return json.loads(self._buffer[self._mark:self._pos])
+        finally:
+            self._mark = None
+
+    async def _expect(self, expected):
+        char = await self._peek()
+        if char != expected:
+            raise ValueError(f'Expected {expected!r} in JSON document, got {char!r}')
+        self._pos += 1
+
+    async def _select_object(self, spec):
+        result = {}
+        self._pos += 1
+        while True:
+            char = await self._peek()
+            if char == '}':
+                self._pos += 1
+                return result
+            if char == ',':
+                self._pos += 1
+                continue
+
+            self._mark = self._pos
+            await self._skip_string()
+            key = json.loads(self._buffer[self._mark:self._pos])
+            self._mark = None
+            await self._expect(':')
+
+            if key in spec:
+                result[key] = await self._select(spec[key])
+            else:
+                await self._skip_value()
+
+    async def _select_array(self, spec):
+        result = []
+        self._pos += 1
+        while True:
+            char = await self._peek()
+            if char == ']':
+                self._pos += 1
+                break
+            if char == ',':
+                self._pos += 1
+                continue
+            result.append(await self._select(spec))
+            if self._on_records is not None and len(result) >= self._slice_size:
+                await self._on_records(result)
+                result = []
+
+        if self._on_records is not None:
+            if result:
+                await self._on_records(result)
+            return []
+        return result
+
+    async def _select(self, spec):
+        char = await self._peek()
+        if spec is not None:
+            if char == '{':
+                return await self._select_object(spec)
+            if char == '[' and _ITEMS in spec:
+                return await self._select_array(spec[_ITEMS])
+        # kept as a whole, or not the shape the spec expects
+        return await self._keep_value()
+
+    async def select(self, spec):
+        """
+        Decode the parts of the document selected by spec
+
+        Returns:
+            the document with everything outside spec left out
+        """
+        return await self._select(spec)
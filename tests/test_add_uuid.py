@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the add-uuid filter plugin, run outside of Fledge with the
+stand-ins of benchmarks/_plugins.py
+
+Usage: python3 -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from _plugins import load_plugin
+
+plugin = load_plugin('filter', 'add-uuid')
+transform = load_plugin('filter', 'transform-to-asyncapi')
+
+
+class AddUuidTest(unittest.TestCase):
+
+    def test_leaves_get_their_versions(self):
+        elements = [{'asset': 'a', 'readings': {'v': 1, 'meta': {'keep': True}}} for _ in range(3)]
+        plugin.compile_uuids({'id': 'uuid', 'meta': {'order': 'uuid7'}})(elements)
+        for element in elements:
+            readings = element['readings']
+            self.assertEqual(uuid.UUID(readings['id']).version, 4)
+            self.assertEqual(uuid.UUID(readings['meta']['order']).version, 7)
+            self.assertTrue(readings['meta']['keep'])
+        self.assertEqual(len({element['readings']['id'] for element in elements}), 3)
+
+    def test_uuid7_is_time_ordered(self):
+        elements = [{'readings': {}} for _ in range(100)]
+        plugin.compile_uuids({'id': 'uuid7'})(elements)
+        ids = [element['readings']['id'] for element in elements]
+        self.assertEqual(ids, sorted(ids))
+
+    def test_uuid5(self):
+        add = plugin.compile_uuids({'id': {'UUID5': {'FIELDS': ['asset', 'n'], 'NAMESPACE': 'dns'}}})
+        element = {'asset': 'a', 'readings': {'n': 1}}
+        add([element])
+        self.assertEqual(element['readings']['id'], str(uuid.uuid5(uuid.NAMESPACE_DNS, 'a\x1f1')))
+
+
+class Uuid5AcrossFiltersTest(unittest.TestCase):
+    """ The same fields give the same uuid in add-uuid and transform-to-asyncapi """
+
+    def assertSameUuid(self, fields, element):
+        spec = {'FIELDS': fields}
+        added = plugin._compile_uuid5(spec, 16)(element)
+        transformed = transform._compile_uuid5(spec)(element['readings'], element)
+        self.assertEqual(added, transformed)
+        return added
+
+    def test_top_level_fields(self):
+        self.assertSameUuid(None, {'asset': 'a', 'timestamp': '2024-01-01', 'readings': {}})
+        self.assertSameUuid(['asset', 'v'], {'asset': 'a', 'readings': {'v': 1.5}})
+
+    def test_missing_and_none_values_are_empty(self):
+        none = self.assertSameUuid(['asset', 'v'], {'asset': 'a', 'readings': {'v': None}})
+        missing = self.assertSameUuid(['asset', 'v'], {'asset': 'a', 'readings': {}})
+        self.assertEqual(none, missing)
+
+    def test_nested_fields(self):
+        element = {'asset': 'a', 'readings': {'a': {'b': [{'c': 7}]}, 'x.y': 3}}
+        nested = self.assertSameUuid(['a.b[0].c', 'x.y'], element)
+        self.assertEqual(nested, str(uuid.uuid5(uuid.NAMESPACE_URL, '7\x1f3')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the get-from-rest south plugin, run outside of Fledge with the
+stand-ins of benchmarks/_plugins.py
+
+Usage: python3 -m unittest discover tests
+"""
+
+import asyncio
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from _plugins import load_plugin
+
+plugin = load_plugin('south', 'get-from-rest')
+
+
+def endpoint(**options):
+    options.setdefault('wrapper', {'v': 'v'})
+    return plugin.Endpoint(url='http://localhost/', headers={}, asset='test',
+                           interval=1, **options)
+
+
+class BatchRecordsTest(unittest.TestCase):
+
+    def test_record_missing_a_field_is_skipped(self):
+        rows = endpoint(records='rows')
+        with self.assertLogs(level='WARNING'):
+            data = rows.format_data({'rows': [{'v': 1}, {'x': 2}, {'v': 3}]})
+        self.assertEqual([reading['readings'] for reading in data], [{'v': 1}, {'v': 3}])
+        self.assertEqual(rows.bad_records, 1)
+
+    def test_record_of_the_wrong_shape_is_skipped(self):
+        rows = endpoint(records='rows')
+        with self.assertLogs(level='WARNING'):
+            data = rows.format_data({'rows': [5, None, [1], {'v': 2}]})
+        self.assertEqual([reading['readings'] for reading in data], [{'v': 2}])
+        self.assertEqual(rows.bad_records, 3)
+
+    def test_records_share_the_poll_time(self):
+        data = endpoint(records='rows').format_data({'rows': [{'v': 1}, {'v': 2}]})
+        self.assertEqual(len({reading['timestamp'] for reading in data}), 1)
+
+    def test_single_reading_missing_a_field_raises(self):
+        with self.assertRaises(KeyError):
+            endpoint().format_data({'x': 1})
+
+    def test_streamed_slices_skip_bad_records(self):
+        rows = endpoint(records='rows')
+        slices = []
+
+        async def on_records(records):
+            slices.append(rows.format_records(records, 'now'))
+
+        async def chunks():
+            yield b'{"rows": [{"v": 1}, {"x": 2}, {"v": 3}]}'
+
+        stream = plugin._JsonStream(chunks(), on_records, slice_size=2)
+        with self.assertLogs(level='WARNING'):
+            asyncio.run(stream.select(rows.stream_spec))
+        self.assertEqual([[reading['readings'] for reading in data] for data in slices],
+                         [[{'v': 1}], [{'v': 3}]])
+        self.assertEqual(rows.bad_records, 1)
+
+
+DOCUMENT = {
+    'meta': {'note': 'skip "me" \\ \u00e9\u20ac\U0001f600 ] } [ {', 'list': [1, [2, {'x': '}'}], None]},
+    'rows': [
+        {'v': 'quote " and backslash \\', 'n': -1.5e3, 'ok': True, 'skip': {'deep': ['"]']}},
+        {'v': 'ä€😀 \n\t\u0000 \\"', 'n': 0, 'ok': False, 'skip': None},
+        {'v': '', 'n': 12345678901234567890, 'ok': None, 'skip': '\\'}
+    ],
+    'tail': 'x' * 100
+}
+
+
+def chunked(text, size):
+    data = text.encode()
+
+    async def chunks():
+        for start in range(0, len(data), size):
+            yield data[start:start + size]
+    return chunks()
+
+
+class JsonStreamTest(unittest.TestCase):
+
+    def select(self, text, spec, size, on_records=None, slice_size=1):
+        stream = plugin._JsonStream(chunked(text, size), on_records, slice_size)
+        return asyncio.run(stream.select(spec))
+
+    def test_whole_document(self):
+        for text in (json.dumps(DOCUMENT), json.dumps(DOCUMENT, ensure_ascii=False),
+                     json.dumps(DOCUMENT, indent=4)):
+            for size in (1, 2, 3, 7, 64, 100000):
+                with self.subTest(size=size):
+                    self.assertEqual(self.select(text, None, size), DOCUMENT)
+
+    def test_selected_parts(self):
+        rows = endpoint(records='rows', wrapper={'v': 'v', 'n': 'n', 'ok': 'ok'})
+        expected = {'rows': [{'v': row['v'], 'n': row['n'], 'ok': row['ok']}
+                             for row in DOCUMENT['rows']]}
+        for text in (json.dumps(DOCUMENT), json.dumps(DOCUMENT, ensure_ascii=False)):
+            for size in (1, 2, 3, 5, 4096):
+                with self.subTest(size=size):
+                    self.assertEqual(self.select(text, rows.stream_spec, size), expected)
+
+    def test_streamed_slices(self):
+        rows = endpoint(records='rows')
+        text = json.dumps({'rows': [{'v': index} for index in range(7)], 'after': [1]})
+        for size in (1, 4, 4096):
+            slices = []
+
+            async def on_records(records):
+                slices.append([record['v'] for record in records])
+
+            with self.subTest(size=size):
+                self.assertEqual(self.select(text, rows.stream_spec, size, on_records, 3),
+                                 {'rows': []})
+                self.assertEqual(slices, [[0, 1, 2], [3, 4, 5], [6]])
+
+    def test_other_shapes_are_kept_whole(self):
+        rows = endpoint(records='rows')
+        for document in ({'rows': 'none'}, {'rows': None}, [1, 2], 'text', 5, None):
+            with self.subTest(document=document):
+                self.assertEqual(self.select(json.dumps(document), rows.stream_spec, 2),
+                                 document)
+
+    def test_truncated_document(self):
+        rows = endpoint(records='rows')
+        for text in ('{"rows": [{"v": 1}', '{"rows": [{"v": "abc', '{"skip": "\\"'):
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                self.select(text, rows.stream_spec, 3)
+
+
+class TimestampTest(unittest.TestCase):
+
+    def reading(self, value, timestamp_format='iso8601'):
+        stamped = endpoint(timestamp='ts', timestamp_format=timestamp_format)
+        return stamped, stamped.format_reading({'v': 1, 'ts': value}, 'poll')
+
+    def test_iso8601(self):
+        _, data = self.reading('2024-02-29T23:59:59.5+02:00')
+        self.assertEqual(data['timestamp'], '2024-02-29 21:59:59.500000+00:00')
+
+    def test_epochs(self):
+        _, data = self.reading(1704067200.25, 'epoch_s')
+        self.assertEqual(data['timestamp'], '2024-01-01 00:00:00.250000+00:00')
+        _, data = self.reading('1704067200250', 'epoch_ms')
+        self.assertEqual(data['timestamp'], '2024-01-01 00:00:00.250000+00:00')
+
+    def test_bad_values_keep_the_poll_time(self):
+        for value, timestamp_format in (('2024-02-30T00:00:00Z', 'iso8601'),
+                                        ('2024-01-01T24:00:00Z', 'iso8601'),
+                                        ('2024-01-01T00:00:61Z', 'iso8601'),
+                                        (1704067200, 'iso8601'),
+                                        ('yesterday', 'epoch_s'),
+                                        (1e20, 'epoch_ms'),
+                                        (-1e20, 'epoch_ms'),
+                                        (float('nan'), 'epoch_s'),
+                                        ('2024', '%Y-%m-%d')):
+            with self.subTest(value=value), self.assertLogs(level='WARNING'):
+                stamped, data = self.reading(value, timestamp_format)
+                self.assertEqual(data['timestamp'], 'poll')
+                self.assertEqual(stamped.bad_timestamps, 1)
+
+    def test_missing_value_is_counted_quietly(self):
+        stamped = endpoint(timestamp='ts')
+        data = stamped.format_reading({'v': 1}, 'poll')
+        self.assertEqual(data['timestamp'], 'poll')
+        self.assertEqual((stamped.missing_timestamps, stamped.bad_timestamps), (1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
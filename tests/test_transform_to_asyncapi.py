@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the transform-to-asyncapi filter plugin, run outside of Fledge
+with the stand-ins of benchmarks/_plugins.py
+
+Usage: python3 -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+from _plugins import load_plugin
+
+plugin = load_plugin('filter', 'transform-to-asyncapi')
+
+
+def fill(value, spec, location='v'):
+    config = {'LOCATION': location, 'FORMAT': spec}
+    return plugin._compile_placeholder(config)({location: value})
+
+
+class FormatTest(unittest.TestCase):
+
+    def test_types(self):
+        self.assertEqual(fill('2.5', 'float'), 2.5)
+        self.assertEqual(fill('2.5', 'int'), 2)
+        self.assertEqual(fill(3, 'str'), '3')
+        self.assertIs(fill('Yes', 'bool'), True)
+        self.assertIs(fill(0, 'bool'), False)
+
+    def test_scale_offset_round(self):
+        self.assertEqual(fill(1234, {'scale': 0.001, 'offset': 1, 'round': 1}), 2.2)
+        self.assertEqual(fill('7', {'offset': 1, 'type': 'int'}), 8)
+
+    def test_missing_and_bad_values(self):
+        self.assertEqual(fill(None, 'float'), plugin.NO_VALUE)
+        self.assertEqual(fill('abc', 'float'), plugin.NO_VALUE)
+        self.assertEqual(fill([1], {'scale': 2}), plugin.NO_VALUE)
+        self.assertEqual(fill(float('inf'), 'int'), plugin.NO_VALUE)
+
+    def test_unknown_type(self):
+        with self.assertRaises(ValueError):
+            plugin._compile_format('decimal')
+
+
+class TimestampFormatTest(unittest.TestCase):
+
+    def test_iso8601(self):
+        self.assertEqual(fill(' 2024-01-01T02:00:00+02:00 ', {'timestamp': 'iso8601'}),
+                         '2024-01-01T00:00:00+00:00')
+        self.assertEqual(fill('2024-01-01T00:00:00Z', {'timestamp': '%d.%m.%Y'}),
+                         '01.01.2024')
+        self.assertEqual(fill('2024-01-01 00:00:00', {'timestamp': 'iso8601'}),
+                         '2024-01-01T00:00:00+00:00')
+
+    def test_epochs(self):
+        self.assertEqual(fill(1704067200, {'timestamp': 'iso8601', 'from': 'epoch_s'}),
+                         '2024-01-01T00:00:00+00:00')
+        self.assertEqual(fill('1704067200000', {'timestamp': 'iso8601', 'from': 'epoch_ms'}),
+                         '2024-01-01T00:00:00+00:00')
+
+    def test_bad_values_give_no_value(self):
+        for value, source in ((1704067200, 'iso8601'),
+                              ('', 'iso8601'),
+                              ('2024-02-30T00:00:00Z', 'iso8601'),
+                              ('not a date', 'iso8601'),
+                              ({'a': 1}, 'epoch_s'),
+                              (1e20, 'epoch_ms'),
+                              (-1e20, 'epoch_ms'),
+                              (float('nan'), 'epoch_s'),
+                              ('soon', 'epoch_ms')):
+            with self.subTest(value=value, source=source):
+                self.assertEqual(fill(value, {'timestamp': 'iso8601', 'from': source}),
+                                 plugin.NO_VALUE)
+
+    def test_bad_value_keeps_the_rest_of_the_block(self):
+        render_block = plugin.compile_block_template({
+            'time': {'CONFIG': {'LOCATION': 'ts', 'FORMAT': {'timestamp': 'iso8601'}}},
+            'value': {'CONFIG': {'LOCATION': 'v', 'FORMAT': 'float'}}
+        })
+        outputs = render_block([{'ts': '2024-01-01T00:00:00Z', 'v': '1'},
+                                {'ts': 1704067200, 'v': 'x'}])
+        self.assertEqual(outputs, [{'time': '2024-01-01T00:00:00+00:00', 'value': 1.0},
+                                   {'time': plugin.NO_VALUE, 'value': plugin.NO_VALUE}])
+
+
+class SchemaTest(unittest.TestCase):
+
+    def errors(self, schema, value):
+        return plugin.compile_schema(schema)(value)
+
+    def assertValid(self, schema, *values):
+        for value in values:
+            with self.subTest(value=value):
+                self.assertEqual(self.errors(schema, value), [])
+
+    def assertInvalid(self, schema, *values):
+        for value in values:
+            with self.subTest(value=value):
+                self.assertNotEqual(self.errors(schema, value), [])
+
+    def test_types(self):
+        self.assertValid({'type': 'integer'}, 1, 1.0, -3)
+        self.assertInvalid({'type': 'integer'}, 1.5, True, '1', None)
+        self.assertValid({'type': 'number'}, 1, 1.5)
+        self.assertInvalid({'type': 'number'}, False, '1.5')
+        self.assertValid({'type': ['string', 'null']}, 'a', None)
+        self.assertInvalid({'type': 'boolean'}, 0, 1)
+
+    def test_enum_and_const_tell_booleans_from_numbers(self):
+        self.assertValid({'enum': [1, 2]}, 1, 2.0)
+        self.assertInvalid({'enum': [1, 2]}, True, '1')
+        self.assertValid({'const': True}, True)
+        self.assertInvalid({'const': True}, 1, 1.0)
+        self.assertInvalid({'const': 0}, False)
+        self.assertValid({'enum': [[1, True], {'a': False}]}, [1, True], {'a': False})
+        self.assertInvalid({'enum': [[1, True], {'a': False}]}, [True, 1], [1, 1], {'a': 0})
+
+    def test_object_keywords(self):
+        schema = {'type': 'object', 'required': ['a'],
+                  'properties': {'a': {'type': 'string'}},
+                  'additionalProperties': False}
+        self.assertValid(schema, {'a': 'x'})
+        self.assertInvalid(schema, {}, {'a': 1}, {'a': 'x', 'b': 1}, [])
+        # without type other values are not checked by the object keywords
+        self.assertValid({'required': ['a']}, 5, 'text')
+
+    def test_array_keywords(self):
+        schema = {'type': 'array', 'items': {'minimum': 0}, 'minItems': 1, 'maxItems': 2}
+        self.assertValid(schema, [0], [1, 2])
+        self.assertInvalid(schema, [], [1, 2, 3], [-1], {})
+
+    def test_bounds(self):
+        self.assertValid({'minimum': 1, 'exclusiveMaximum': 3}, 1, 2.9, 'not a number')
+        self.assertInvalid({'minimum': 1, 'exclusiveMaximum': 3}, 0.5, 3)
+        self.assertValid({'minLength': 2, 'maxLength': 3, 'pattern': '^a'}, 'ab', 'abc', 5)
+        self.assertInvalid({'minLength': 2, 'maxLength': 3, 'pattern': '^a'}, 'a', 'abcd', 'ba')
+
+    def test_combined(self):
+        self.assertValid({'anyOf': [{'type': 'string'}, {'minimum': 5}]}, 'a', 6)
+        self.assertInvalid({'anyOf': [{'type': 'string'}, {'minimum': 5}]}, 4)
+        self.assertValid({'oneOf': [{'type': 'integer'}, {'minimum': 5}]}, 1, 5.5)
+        self.assertInvalid({'oneOf': [{'type': 'integer'}, {'minimum': 5}]}, 6, 2.5)
+        self.assertInvalid({'allOf': [{'type': 'integer'}, {'minimum': 5}]}, 4, 5.5)
+
+    def test_references(self):
+        schema = {'$ref': '#/definitions/node',
+                  'definitions': {'node': {'type': 'object', 'properties': {
+                      'child': {'$ref': '#/definitions/node'},
+                      'value': {'type': 'integer'}}}}}
+        self.assertValid(schema, {'value': 1, 'child': {'value': 2}})
+        self.assertInvalid(schema, {'child': {'child': {'value': 'x'}}})
+
+    def test_asyncapi_2_payload(self):
+        document = {
+            'asyncapi': '2.6.0',
+            'channels': {'readings': {'publish': {'message': {'$ref': '#/components/messages/reading'}}}},
+            'components': {'messages': {'reading': {'payload': {'$ref': '#/components/schemas/reading'}}},
+                           'schemas': {'reading': {'type': 'object', 'required': ['value']}}}
+        }
+        self.assertValid(document, {'value': 1})
+        self.assertInvalid(document, {})
+
+    def test_asyncapi_3_payload(self):
+        document = {
+            'asyncapi': '3.0.0',
+            'channels': {'readings': {'$ref': '#/components/channels/readings'}},
+            'operations': {'send': {'action': 'send', 'channel': {'$ref': '#/channels/readings'}}},
+            'components': {
+                'channels': {'readings': {'messages': {'reading': {'payload': {
+                    'schemaFormat': 'application/schema+json;version=draft-07',
+                    'schema': {'type': 'object', 'required': ['value']}}}}}}
+            }
+        }
+        self.assertValid(document, {'value': 1})
+        self.assertInvalid(document, {})
+
+    def test_asyncapi_without_payload(self):
+        with self.assertRaises(ValueError):
+            plugin.compile_schema({'asyncapi': '3.0.0', 'channels': {'readings': {}}})
+
+
+if __name__ == '__main__':
+    unittest.main()